@@ -0,0 +1,185 @@
+import atexit
+import logging
+import queue
+import threading
+from django.conf import settings
+from django.contrib.admin.models import LogEntry
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+
+logger = logging.getLogger(__name__)
+
+# Largest number of entries written by one bulk insert.
+AUDIT_BATCH_SIZE = 100
+# Seconds the worker waits for more entries before writing a partial batch.
+AUDIT_FLUSH_INTERVAL = 1.0
+# Entries buffered before callers fall back to writing synchronously.
+AUDIT_QUEUE_SIZE = 10000
+
+_queue = queue.Queue(maxsize=AUDIT_QUEUE_SIZE)
+_lock = threading.Lock()
+_worker = None
+_stopped = False
+
+
+def is_async():
+    """
+    Audit entries are written by the background worker unless the
+    AUDIT_LOG_ASYNC setting is False, e.g. for tests or management
+    commands that want every entry in the database before they return.
+    """
+    return getattr(settings, 'AUDIT_LOG_ASYNC', True) and not _stopped
+
+
+def log_action(user_id, obj, action_flag, change_message='',
+               object_repr=None):
+    """
+    Records a LogEntry for an object without waiting for the database.
+    The object's repr is taken here, while the object is in the state
+    being logged; only the insert is left to the worker.
+    """
+    enqueue(LogEntry(
+        user_id=user_id,
+        # get_for_model is served from ContentType's in-process cache
+        # after the first lookup of each model.
+        content_type_id=ContentType.objects.get_for_model(obj).pk,
+        object_id=str(obj.pk),
+        object_repr=(object_repr or repr(obj))[:200],
+        action_flag=action_flag,
+        change_message=change_message,
+    ))
+
+
+def enqueue(instance):
+    """
+    Hands an unsaved model instance to the worker to be inserted.
+    If the buffer is full or the worker cannot run, the instance is
+    written synchronously instead, so entries are never dropped.
+    """
+    if is_async() and start():
+        try:
+            _queue.put_nowait(instance)
+            return
+        except queue.Full:
+            pass
+    write([instance])
+
+
+def write(instances):
+    """
+    Writes buffered instances with one bulk insert per model.
+    Note that LogEntry.action_time is set when the entry is written, so
+    buffered entries are stamped up to AUDIT_FLUSH_INTERVAL seconds late.
+    """
+    by_model = {}
+    for instance in instances:
+        by_model.setdefault(type(instance), []).append(instance)
+    for model, batch in by_model.items():
+        model.objects.bulk_create(batch)
+
+
+def take_batch(timeout):
+    """
+    Waits up to timeout seconds for an entry, then takes whatever else
+    is already buffered, up to AUDIT_BATCH_SIZE entries.
+    """
+    try:
+        batch = [_queue.get(timeout=timeout)]
+    except queue.Empty:
+        return []
+    while len(batch) < AUDIT_BATCH_SIZE:
+        try:
+            batch.append(_queue.get_nowait())
+        except queue.Empty:
+            break
+    return batch
+
+
+def write_batch(batch, reconnect=False):
+    """
+    Writes a batch taken from the queue. If the bulk insert fails, the
+    entries are written again one at a time, so a transient error or one
+    bad entry does not lose the whole batch; only entries that fail again
+    are logged and dropped.
+    :param reconnect: Whether to close the connection before retrying, in
+                      case the error broke it. Only the worker may do so,
+                      since the caller of flush() may be in a transaction.
+    """
+    try:
+        try:
+            # Savepoints keep a failed insert from breaking a transaction
+            # the caller of flush() may be in.
+            with transaction.atomic():
+                write(batch)
+        except Exception:
+            logger.warning('Could not write %d audit log entries at once; '
+                           'retrying them one at a time.', len(batch),
+                           exc_info=True)
+            if reconnect:
+                connection.close()
+            for instance in batch:
+                try:
+                    with transaction.atomic():
+                        write([instance])
+                except Exception:
+                    logger.exception('Could not write audit log entry %r.',
+                                     instance.__dict__)
+    finally:
+        for _ in batch:
+            _queue.task_done()
+
+
+def run():
+    while not _stopped:
+        batch = take_batch(AUDIT_FLUSH_INTERVAL)
+        if batch:
+            write_batch(batch, reconnect=True)
+        elif _queue.empty():
+            # Don't hold a database connection open while idle.
+            connection.close()
+
+
+def start():
+    """
+    Starts the background worker if it is not running yet.
+    :return: Whether the worker is running.
+    """
+    global _worker
+    if _worker is not None and _worker.is_alive():
+        return True
+    with _lock:
+        if _worker is None or not _worker.is_alive():
+            try:
+                _worker = threading.Thread(target=run, name='audit-log')
+                _worker.daemon = True
+                _worker.start()
+            except RuntimeError:
+                _worker = None
+                return False
+    return True
+
+
+def flush():
+    """
+    Writes every buffered entry before returning. Entries the worker has
+    already taken are waited for; the rest are written by the caller.
+    """
+    while True:
+        batch = take_batch(0)
+        if not batch:
+            break
+        write_batch(batch)
+    _queue.join()
+
+
+@atexit.register
+def shutdown():
+    """
+    Stops the worker and writes whatever is still buffered, so entries
+    survive a graceful shutdown. Later entries are written synchronously.
+    """
+    global _stopped
+    _stopped = True
+    flush()
+    if _worker is not None:
+        _worker.join(AUDIT_FLUSH_INTERVAL * 2)
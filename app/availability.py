@@ -0,0 +1,194 @@
+import datetime
+import math
+import pytz
+from django.db import transaction
+from django.utils import timezone
+from .models import *
+
+# Length of one slot in the availability grid, in minutes. Slots follow
+# the local wall clock: slot i starts i * SLOT_MINUTES minutes after
+# midnight as shown on a clock, so a day always has SLOTS_PER_DAY slots.
+# When clocks go forward the skipped slots are never busy; when they go
+# back, both occurrences of the repeated hour share the same slots.
+SLOT_MINUTES = 15
+SLOTS_PER_DAY = 24 * 60 // SLOT_MINUTES
+# How many days ahead, starting today, are kept precomputed.
+WINDOW_DAYS = 28
+
+
+def day_bounds(day):
+    """
+    :return: The aware datetimes at which a local calendar day starts and
+             ends.
+    """
+    zone = timezone.get_current_timezone()
+    start = timezone.make_aware(datetime.datetime.combine(day, datetime.time()),
+                                zone)
+    end = timezone.make_aware(datetime.datetime.combine(
+        day + datetime.timedelta(days=1), datetime.time()), zone)
+    return start, end
+
+
+def days_between(start, end):
+    """
+    :return: Every local calendar day that the period [start, end] touches.
+    """
+    first = timezone.localtime(start).date()
+    last = timezone.localtime(end).date()
+    return [first + datetime.timedelta(days=i)
+            for i in range((last - first).days + 1)]
+
+
+def window():
+    today = timezone.localtime(timezone.now()).date()
+    return [today + datetime.timedelta(days=i) for i in range(WINDOW_DAYS)]
+
+
+def wall_clock_minutes(moment, day):
+    """
+    :return: The minutes from the local midnight starting day to the
+             local wall-clock time of the aware datetime moment.
+    """
+    local = timezone.localtime(moment).replace(tzinfo=None)
+    midnight = datetime.datetime.combine(day, datetime.time())
+    return (local - midnight).total_seconds() / 60.0
+
+
+def busy_mask(periods, day):
+    """
+    Builds the bitmap of a day's busy slots: bit i is set when any of the
+    (start, end) periods overlaps the i-th wall-clock slot of the day.
+    """
+    bits = 0
+    for busy_start, busy_end in periods:
+        # An appointment across the hour repeated when clocks go back can
+        # end earlier on the wall clock than it starts.
+        start, end = sorted((wall_clock_minutes(busy_start, day),
+                             wall_clock_minutes(busy_end, day)))
+        if end <= 0 or start >= SLOTS_PER_DAY * SLOT_MINUTES:
+            continue
+        first = max(int(start // SLOT_MINUTES), 0)
+        last = min(int(math.ceil(end / SLOT_MINUTES)), SLOTS_PER_DAY)
+        for i in range(first, last):
+            bits |= 1 << i
+    return bits
+
+
+def to_bytes(bits):
+    return bits.to_bytes(SLOTS_PER_DAY // 8, 'little')
+
+
+def from_bytes(data):
+    return int.from_bytes(bytes(data), 'little')
+
+
+def compute(doctor_ids, days, exclude=None):
+    """
+    Computes busy bitmaps for several doctors and days from one query
+    over the appointments that overlap them.
+    :param exclude: Primary key of an appointment to leave out, such as
+                    one being edited, which should not count as busy.
+    :return: A dictionary mapping (doctor id, day) to the bitmap.
+    """
+    start, end = day_bounds(min(days))[0], day_bounds(max(days))[1]
+    periods = {pk: [] for pk in doctor_ids}
+    appointments = Appointment.objects.filter(doctor__in=doctor_ids,
+                                              date__lt=end, end_date__gt=start)
+    if exclude is not None:
+        appointments = appointments.exclude(pk=exclude)
+    for doctor, date, end_date in appointments.values_list('doctor', 'date',
+                                                           'end_date'):
+        periods[doctor].append((date, end_date))
+    return {(pk, day): busy_mask(periods[pk], day)
+            for pk in doctor_ids for day in days}
+
+
+def refresh(doctor_ids, days):
+    """
+    Recomputes and stores the bitmaps for the given doctors and days,
+    replacing any stored ones.
+    The doctors' rows are locked first, so concurrent refreshes for the
+    same doctor run one after the other instead of inserting the same
+    (doctor, day) rows twice.
+    :return: The recomputed bitmaps, keyed like compute().
+    """
+    doctor_ids, days = sorted(doctor_ids), list(days)
+    if not doctor_ids or not days:
+        return {}
+    with transaction.atomic():
+        list(User.objects.select_for_update().filter(pk__in=doctor_ids)
+                         .order_by('pk').values_list('pk', flat=True))
+        masks = compute(doctor_ids, days)
+        DoctorAvailability.objects.filter(doctor__in=doctor_ids,
+                                          day__in=days).delete()
+        DoctorAvailability.objects.bulk_create([
+            DoctorAvailability(doctor_id=pk, day=day, busy=to_bytes(bits))
+            for (pk, day), bits in masks.items()])
+    return masks
+
+
+def appointment_changed(doctor_id, start, end):
+    """
+    Updates the stored bitmaps of the days an appointment occupied or
+    now occupies. Only days inside the precomputed window are stored, so
+    only those need refreshing.
+    """
+    days = sorted(set(days_between(start, end)) & set(window()))
+    if days:
+        refresh([doctor_id], days)
+
+
+def grid(doctor_ids, start_day, days=7):
+    """
+    Reads the busy bitmaps of several doctors over consecutive days.
+    Days inside the precomputed window are read from the stored bitmaps
+    with a single query, and any missing ones are computed and stored on
+    the way. Days outside the window are always computed and never
+    stored, since appointment changes only refresh the window.
+    :return: A dictionary mapping each doctor id to a dictionary of day to
+             busy bitmap.
+    """
+    doctor_ids = list(doctor_ids)
+    day_list = [start_day + datetime.timedelta(days=i) for i in range(days)]
+    stored_days = sorted(set(day_list) & set(window()))
+    masks = {}
+    if stored_days:
+        masks = {(row.doctor_id, row.day): from_bytes(row.busy)
+                 for row in DoctorAvailability.objects.filter(
+                     doctor__in=doctor_ids, day__in=stored_days)}
+        missing = [(pk, day) for pk in doctor_ids for day in stored_days
+                   if (pk, day) not in masks]
+        if missing:
+            masks.update(refresh({pk for pk, _ in missing},
+                                 sorted({day for _, day in missing})))
+    other_days = sorted(set(day_list) - set(stored_days))
+    if other_days and doctor_ids:
+        masks.update(compute(doctor_ids, other_days))
+    return {pk: {day: masks[(pk, day)] for day in day_list}
+            for pk in doctor_ids}
+
+
+def slot_start(day, slot):
+    """
+    :return: The aware datetime at which a wall-clock slot starts, or None
+             for slots skipped when clocks go forward. When clocks go back,
+             the slot's first occurrence is used.
+    """
+    zone = timezone.get_current_timezone()
+    naive = datetime.datetime.combine(day, datetime.time()) + \
+        datetime.timedelta(minutes=slot * SLOT_MINUTES)
+    try:
+        return timezone.make_aware(naive, zone)
+    except pytz.AmbiguousTimeError:
+        return zone.localize(naive, is_dst=True)
+    except pytz.NonExistentTimeError:
+        return None
+
+
+def free_slots(bits, day):
+    """
+    :return: The start times of the free slots in a day's bitmap.
+    """
+    starts = [slot_start(day, i) for i in range(SLOTS_PER_DAY)
+              if not bits & (1 << i)]
+    return [start for start in starts if start is not None]
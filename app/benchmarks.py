@@ -0,0 +1,215 @@
+"""
+Query-count, latency and memory benchmarks for every named route.
+
+They are not part of the regular test run, since seeding the dataset
+takes a while. Run them with
+
+    python manage.py test app.benchmarks
+
+against SQLite, or against a local PostgreSQL by pointing DATABASE_URL
+at it. Environment variables tune the run:
+
+    BENCHMARK_PATIENTS        patients in the dataset (default 2000)
+    BENCHMARK_ITERATIONS      timed requests per route (default 20)
+    BENCHMARK_UPDATE_BUDGETS  set to 1 to rewrite benchmark_budgets.json
+                              from this run instead of checking it
+
+A route fails when its worst query count or its p95 latency is over the
+budget stored for it in benchmark_budgets.json.
+"""
+import datetime
+import json
+import os
+import time
+import tracemalloc
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from . import ical
+from . import synthetic
+from . import urls
+from .models import *
+
+BUDGETS_FILE = os.path.join(os.path.dirname(__file__), 'benchmark_budgets.json')
+PATIENTS = int(os.environ.get('BENCHMARK_PATIENTS', 2000))
+ITERATIONS = int(os.environ.get('BENCHMARK_ITERATIONS', 20))
+UPDATE_BUDGETS = os.environ.get('BENCHMARK_UPDATE_BUDGETS') == '1'
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(round(fraction * (len(values) - 1))),
+                      len(values) - 1)]
+
+
+# Every named route, the role to request it as (None for anonymous) and
+# a function returning its URL arguments and query string. Routes that
+# delete something get a fresh object for every request.
+ROUTES = [
+    ('login', None, None),
+    ('logout', 'patient', None),
+    ('home', 'patient', None),
+    ('home1', None, None),
+    ('signup', None, None),
+    ('schedule', 'doctor', None),
+    ('calendar_feed', None,
+     lambda b: ((b.doctor.pk, ical.feed_token(b.doctor)), {})),
+    ('availability', 'doctor', None),
+    ('add_appointment', 'doctor', None),
+    ('edit_appointment', 'doctor', lambda b: ((b.appointment.pk,), {})),
+    ('delete_appointment', 'doctor', lambda b: ((b.new_appointment().pk,), {})),
+    ('prescriptions', 'doctor', None),
+    ('add_prescription', 'doctor', None),
+    ('edit_prescription', 'doctor', lambda b: ((b.prescription.pk,), {})),
+    ('delete_prescription', 'doctor',
+     lambda b: ((b.new_prescription().pk,), {})),
+    ('messages', 'patient', None),
+    ('conversation', 'patient', lambda b: ((b.group.pk,), {})),
+    ('older_messages', 'patient', lambda b: ((b.group.pk,), {})),
+    ('add_group', 'patient', None),
+    ('medical_information', 'doctor', lambda b: ((b.patient.pk,), {})),
+    ('my_medical_information', 'patient', None),
+    ('export', 'patient', lambda b: ((b.patient.pk,), {})),
+    ('export_me', 'patient', None),
+    ('export_patients', 'admin', None),
+    ('users', 'admin', None),
+    ('search', 'doctor', lambda b: ((), {'q': synthetic.LAST_NAMES[0]})),
+    ('logs', 'admin', None),
+    ('sql_profile', 'admin', None),
+]
+
+
+@override_settings(
+    AUDIT_LOG_ASYNC=False,
+    # Logging in before every request should not dominate the run.
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class RouteBenchmark(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        started = time.time()
+        data = synthetic.Generator(seed=0).generate(
+            hospitals=3, doctors=max(PATIENTS // 50, 3),
+            nurses=max(PATIENTS // 100, 3), patients=PATIENTS)
+        # Users are admitted round-robin, so these share a hospital.
+        cls.doctor = User.objects.get(pk=data['doctors'][0])
+        cls.patient = User.objects.get(pk=data['patients'][0])
+        cls.admin = User.objects.create_superuser(
+            'admin@example.com', email='admin@example.com',
+            password=synthetic.PASSWORD, first_name='Admin', last_name='User',
+            phone_number='5550000000', date_of_birth=datetime.date(1980, 1, 1))
+        Group.objects.get(name='Doctor').user_set.add(cls.admin)
+        cls.doctor.hospital().admit(cls.admin)
+        cls.group = MessageGroup.objects.filter(members=cls.patient).first()
+        cls.appointment = Appointment.objects.create(
+            doctor=cls.doctor, patient=cls.patient, duration=30,
+            date=timezone.now() + datetime.timedelta(days=3))
+        cls.prescription = Prescription.objects.filter(
+            patient=cls.patient).first()
+        cls.seconds_to_seed = time.time() - started
+        cls.results = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        super(RouteBenchmark, cls).tearDownClass()
+        print('\n%d patients, seeded in %.1fs, %d requests per route'
+              % (PATIENTS, cls.seconds_to_seed, ITERATIONS))
+        print('%-24s %8s %9s %9s %10s'
+              % ('route', 'queries', 'p50 ms', 'p95 ms', 'peak KiB'))
+        for name, result in sorted(cls.results.items()):
+            print('%-24s %8d %9.1f %9.1f %10.0f' % (
+                name, result['queries'], result['p50_ms'],
+                result['p95_ms'], result['peak_kib']))
+        if UPDATE_BUDGETS and cls.results:
+            with open(BUDGETS_FILE, 'w') as f:
+                json.dump({name: {
+                    'queries': result['queries'],
+                    # Leave headroom for slower machines.
+                    'p95_ms': max(int(result['p95_ms'] * 3), 50),
+                } for name, result in cls.results.items()},
+                    f, indent=2, sort_keys=True)
+                f.write('\n')
+
+    def users(self):
+        return {'admin': self.admin, 'doctor': self.doctor,
+                'patient': self.patient}
+
+    def new_appointment(self):
+        # Far enough ahead that it never touches the availability window.
+        return Appointment.objects.create(
+            doctor=self.doctor, patient=self.patient, duration=30,
+            date=timezone.now() + datetime.timedelta(days=400))
+
+    def new_prescription(self):
+        return Prescription.objects.create(
+            patient=self.patient, name='Placebo', dosage='1 mg',
+            directions='As needed.', prescribed=timezone.now(), active=True)
+
+    def request(self, name, role, arguments):
+        """
+        Logs in as the role and requests the route once, reading the
+        whole response so streaming views do all their work.
+        :return: The queries run by the request.
+        """
+        self.client.logout()
+        if role:
+            self.assertTrue(self.client.login(
+                username=self.users()[role].username,
+                password=synthetic.PASSWORD))
+        args, params = arguments(self) if arguments else ((), {})
+        path = reverse('health:' + name, args=args)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(path, params)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        self.assertIn(response.status_code, (200, 302),
+                      '%s returned %d' % (name, response.status_code))
+        return queries
+
+    def measure(self, name, role, arguments):
+        # One untimed request warms the caches, as in production.
+        self.request(name, role, arguments)
+        timings, counts = [], []
+        for _ in range(ITERATIONS):
+            started = time.perf_counter()
+            queries = self.request(name, role, arguments)
+            timings.append((time.perf_counter() - started) * 1000)
+            counts.append(len(queries))
+        # Memory is traced in a separate request, since tracing slows
+        # down the timed ones.
+        tracemalloc.start()
+        try:
+            self.request(name, role, arguments)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return {'queries': max(counts), 'p50_ms': percentile(timings, 0.5),
+                'p95_ms': percentile(timings, 0.95), 'peak_kib': peak / 1024.0}
+
+    def test_routes(self):
+        named = {pattern.name for pattern in urls.urlpatterns if pattern.name}
+        self.assertEqual(named, {name for name, _, _ in ROUTES},
+                         'Every named route needs a benchmark.')
+        with open(BUDGETS_FILE) as f:
+            budgets = json.load(f)
+        failures = []
+        for name, role, arguments in ROUTES:
+            cache.clear()
+            result = self.results[name] = self.measure(name, role, arguments)
+            if UPDATE_BUDGETS:
+                continue
+            budget = budgets.get(name)
+            if budget is None:
+                failures.append('%s has no budget.' % name)
+                continue
+            if result['queries'] > budget['queries']:
+                failures.append('%s ran %d queries; the budget is %d.' % (
+                    name, result['queries'], budget['queries']))
+            if result['p95_ms'] > budget['p95_ms']:
+                failures.append('%s took %.1fms at p95; the budget is %dms.'
+                                % (name, result['p95_ms'], budget['p95_ms']))
+        if failures:
+            self.fail('\n'.join(failures))
@@ -0,0 +1,28 @@
+import time
+from django.conf import settings
+from django.db import connections
+
+
+class ConnectionHealthCheckMiddleware(object):
+    """
+    Closes persistent database connections that have stopped working, so
+    the request opens a fresh one instead of failing on its first query.
+    Django only notices a dead connection after a query on it has failed.
+    A connection is checked at most once every DB_HEALTH_CHECK_INTERVAL
+    seconds (0 turns the checks off), which costs one 'SELECT 1'.
+    """
+
+    def process_request(self, request):
+        interval = getattr(settings, 'DB_HEALTH_CHECK_INTERVAL', 0)
+        if not interval:
+            return None
+        now = time.time()
+        for connection in connections.all():
+            if connection.connection is None:
+                continue
+            if now - getattr(connection, 'health_checked_at', 0) < interval:
+                continue
+            connection.health_checked_at = now
+            if not connection.is_usable():
+                connection.close()
+        return None
@@ -0,0 +1,67 @@
+import json
+from django.db.models import Prefetch
+from .models import *
+
+# Number of users loaded (with their related records) per batch when
+# exporting many users at once.
+EXPORT_CHUNK_SIZE = 500
+
+
+def export_queryset(queryset):
+    """
+    Adds everything User.json_object reads to a queryset of users, so a
+    batch of users is exported in a fixed number of queries no matter how
+    many users, appointments or prescriptions it contains.
+    """
+    appointments = Appointment.objects.select_related('doctor', 'patient')
+    return queryset.select_related('medical_information__insurance',
+                                   'emergency_contact',
+                                   'current_stay__hospital')\
+                   .prefetch_related(
+                       'groups',
+                       'prescription_set',
+                       Prefetch('doctor_appointments', queryset=appointments),
+                       Prefetch('patient_appointments', queryset=appointments))
+
+
+def stream_json(user):
+    """
+    Encodes a user's record as pretty-printed JSON, yielding it in chunks
+    so it can be streamed to the client as it is produced.
+    """
+    encoder = json.JSONEncoder(sort_keys=True, indent=4,
+                               separators=(',', ': '))
+    return encoder.iterencode(user.json_object())
+
+
+def export_chunks(queryset, after=0, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yields the users in a queryset in primary key order, as lists of at
+    most chunk_size users with their related records prefetched.
+    Each chunk is fetched with a keyset query on the primary key, so memory
+    use is bounded by the chunk size rather than the number of users.
+    :param after: Only users with a primary key greater than this are
+                  yielded, which lets an interrupted export resume.
+    """
+    last_pk = after
+    while True:
+        chunk = list(export_queryset(queryset.filter(pk__gt=last_pk)
+                                             .order_by('pk'))[:chunk_size])
+        if not chunk:
+            return
+        yield chunk
+        last_pk = chunk[-1].pk
+
+
+def ndjson_line(user):
+    return json.dumps(user.json_object(), sort_keys=True) + '\n'
+
+
+def stream_ndjson(queryset, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yields the records of every user in a queryset as newline-delimited
+    JSON, one user per line.
+    """
+    for chunk in export_chunks(queryset, chunk_size=chunk_size):
+        for user in chunk:
+            yield ndjson_line(user)
@@ -3,7 +3,7 @@ import re
 from django.core import validators
 from django.core.exceptions import ValidationError
 from django.contrib.admin import models
-from django.contrib.contenttypes.models import ContentType
+from . import auditlog
 from django.utils.text import get_text_list
 
 
@@ -53,13 +53,7 @@ def addition(request, obj):
     """
     Log that an object has been successfully added.
     """
-    models.LogEntry.objects.log_action(
-        user_id=request.user.pk,
-        content_type_id=ContentType.objects.get_for_model(obj).pk,
-        object_id=obj.pk,
-        object_repr=repr(obj),
-        action_flag=models.ADDITION
-    )
+    auditlog.log_action(request.user.pk, obj, models.ADDITION)
 
 
 def change(request, obj, message_or_fields):
@@ -73,24 +67,13 @@ def change(request, obj, message_or_fields):
         message = message_or_fields
     else:
         message = get_change_message(message_or_fields)
-    models.LogEntry.objects.log_action(
-        user_id=request.user.pk,
-        content_type_id=ContentType.objects.get_for_model(obj).pk,
-        object_id=obj.pk,
-        object_repr=repr(obj),
-        action_flag=models.CHANGE,
-        change_message=message
-    )
+    auditlog.log_action(request.user.pk, obj, models.CHANGE,
+                        change_message=message)
 
 
 def deletion(request, obj, object_repr=None):
     """
     Log that an object will be deleted.
     """
-    models.LogEntry.objects.log_action(
-        user_id=request.user.id,
-        content_type_id=ContentType.objects.get_for_model(obj).pk,
-        object_id=obj.pk,
-        object_repr=object_repr or repr(obj),
-        action_flag=models.DELETION
-    )
+    auditlog.log_action(request.user.id, obj, models.DELETION,
+                        object_repr=object_repr)
@@ -0,0 +1,89 @@
+from django.core import signing
+from django.utils import timezone
+
+# Salt for the signed tokens in calendar feed URLs, so they cannot be
+# reused as signatures anywhere else.
+FEED_SALT = 'health.calendar-feed'
+
+
+def feed_token(user):
+    """
+    A secret token identifying a user's calendar feed. Calendar clients
+    cannot log in, so the token in the URL is what authorizes the feed.
+    """
+    return signing.Signer(salt=FEED_SALT).sign(str(user.pk)).split(':', 1)[1]
+
+
+def check_feed_token(user_id, token):
+    try:
+        return signing.Signer(salt=FEED_SALT).unsign(
+            '%s:%s' % (user_id, token)) == str(user_id)
+    except signing.BadSignature:
+        return False
+
+
+def escape(text):
+    """
+    Escapes a value for use in an iCalendar TEXT property (RFC 5545 3.3.11).
+    """
+    return (text.replace('\\', '\\\\').replace(';', '\\;')
+                .replace(',', '\\,').replace('\n', '\\n'))
+
+
+def format_date(date):
+    return timezone.localtime(date, timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def content_line(name, value):
+    """
+    Builds one CRLF-terminated content line, folded so no line is longer
+    than 75 octets (RFC 5545 3.1).
+    """
+    line = ('%s:%s' % (name, value)).encode('utf-8')
+    folded = []
+    while len(line) > 75:
+        cut = 75 if not folded else 74
+        # Never split a multi-byte UTF-8 character.
+        while cut and (line[cut] & 0xC0) == 0x80:
+            cut -= 1
+        folded.append(line[:cut])
+        line = line[cut:]
+    folded.append(line)
+    return b'\r\n '.join(folded).decode('utf-8') + '\r\n'
+
+
+def appointment_event(appointment, user):
+    if appointment.doctor_id == user.pk:
+        summary = 'Appointment with %s' % appointment.patient.get_full_name()
+    else:
+        summary = 'Appointment with Dr. %s' % appointment.doctor.get_full_name()
+    return ''.join([
+        content_line('BEGIN', 'VEVENT'),
+        content_line('UID', 'appointment-%d@health' % appointment.pk),
+        content_line('DTSTAMP', format_date(appointment.modified)),
+        content_line('DTSTART', format_date(appointment.date)),
+        content_line('DTEND', format_date(appointment.end_date)),
+        content_line('SUMMARY', escape(summary)),
+        content_line('DESCRIPTION', escape('%d minutes with %s and %s' % (
+            appointment.duration, appointment.patient.get_full_name(),
+            appointment.doctor.get_full_name()))),
+        content_line('END', 'VEVENT'),
+    ])
+
+
+def stream_calendar(user, appointments):
+    """
+    Yields a user's schedule as an iCalendar document, one event at a
+    time, iterating the queryset without caching it so memory use does
+    not grow with the size of the schedule.
+    """
+    yield ''.join([
+        content_line('BEGIN', 'VCALENDAR'),
+        content_line('VERSION', '2.0'),
+        content_line('PRODID', '-//ED&P//Schedule//EN'),
+        content_line('X-WR-CALNAME', escape('Schedule for %s' %
+                                            user.get_full_name())),
+    ])
+    for appointment in appointments.iterator():
+        yield appointment_event(appointment, user)
+    yield content_line('END', 'VCALENDAR')
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+from health import availability
+from health.models import *
+
+
+class Command(BaseCommand):
+    help = ('Rebuilds the precomputed availability of every doctor for the '
+            'rolling window of upcoming days and drops the days that have '
+            'passed. Run it daily, and after bulk changes to appointments.')
+
+    def handle(self, *args, **options):
+        days = availability.window()
+        past = DoctorAvailability.objects.filter(day__lt=days[0])
+        removed = past.count()
+        past.delete()
+        doctors = list(User.objects.filter(groups__name='Doctor')
+                                   .values_list('pk', flat=True))
+        for start in range(0, len(doctors), 100):
+            availability.refresh(doctors[start:start + 100], days)
+        self.stdout.write('Built %d day%s of availability for %d doctor%s; '
+                          'removed %d past day%s.' % (
+                              len(days), '' if len(days) == 1 else 's',
+                              len(doctors), '' if len(doctors) == 1 else 's',
+                              removed, '' if removed == 1 else 's'))
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from health import search
+from health.models import *
+
+
+class Command(BaseCommand):
+    help = ('Creates the full-text search index for this database and '
+            'rebuilds every user\'s search document.')
+
+    def handle(self, *args, **options):
+        backend = search.build_index()
+        if backend is None:
+            self.stdout.write('No full-text index is available for this '
+                              'database; searches will scan documents.')
+        count = search.index_users(User.objects.all())
+        self.stdout.write('Indexed %d user%s%s.' % (
+            count, '' if count == 1 else 's',
+            ' with the %s index' % backend if backend else ''))
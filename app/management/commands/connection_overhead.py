@@ -0,0 +1,54 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.core import signals
+from django.db import connection
+import time
+
+
+class Command(BaseCommand):
+    help = ('Measures the cost of opening a database connection per request '
+            'by running simulated requests of one query each, first with '
+            'a new connection per request and then with a persistent one.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500,
+                            help='Simulated requests per mode.')
+        parser.add_argument('--max-age', type=int, default=600,
+                            help='CONN_MAX_AGE for the persistent mode.')
+
+    def run(self, requests, max_age):
+        """
+        Runs the simulated requests with CONN_MAX_AGE set to max_age,
+        sending the request signals Django uses to decide when to close
+        the connection.
+        :return: The mean milliseconds per request.
+        """
+        connection.close()
+        connection.settings_dict['CONN_MAX_AGE'] = max_age
+        started = time.time()
+        for _ in range(requests):
+            signals.request_started.send(sender=self.__class__)
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+                cursor.fetchone()
+            signals.request_finished.send(sender=self.__class__)
+        connection.close()
+        return (time.time() - started) * 1000 / requests
+
+    def handle(self, *args, **options):
+        requests = options['requests']
+        if requests < 1:
+            raise CommandError('--requests must be at least 1.')
+        original = connection.settings_dict.get('CONN_MAX_AGE', 0)
+        try:
+            per_request = self.run(requests, 0)
+            persistent = self.run(requests, options['max_age'])
+        finally:
+            connection.settings_dict['CONN_MAX_AGE'] = original
+        self.stdout.write('%s, %d requests per mode:' % (connection.vendor,
+                                                          requests))
+        self.stdout.write('  connection per request: %.3f ms/request'
+                          % per_request)
+        self.stdout.write('  persistent connection:  %.3f ms/request'
+                          % persistent)
+        self.stdout.write('  connection setup:       %.3f ms/request'
+                          % (per_request - persistent))
@@ -0,0 +1,216 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.models import Max, Min
+from django.utils import dateparse
+from health.exports import EXPORT_CHUNK_SIZE, export_chunks, ndjson_line
+from health.models import *
+import gzip
+import json
+import multiprocessing
+import os
+import time
+
+
+# File in the output directory recording the primary key ranges of an
+# export, so a resumed run finds the same ranges and their checkpoints.
+RANGES_CHECKPOINT = 'ranges.checkpoint'
+
+
+def patient_queryset(hospital=None, admitted_after=None, admitted_before=None):
+    """
+    Builds the queryset of patients to export from the command's filters.
+    All the stay conditions go in one filter() call so that they must hold
+    for the same stay, rather than each for any of the patient's stays.
+    Workers rebuild the queryset from these plain values, since evaluating
+    or pickling a queryset across processes would load every row.
+    """
+    stay = {}
+    if hospital is not None:
+        stay['hospitalstay__hospital'] = hospital
+        stay['hospitalstay__discharge__isnull'] = True
+    if admitted_after is not None:
+        stay['hospitalstay__admission__gte'] = admitted_after
+    if admitted_before is not None:
+        stay['hospitalstay__admission__lt'] = admitted_before
+    patients = User.objects.filter(groups__name='Patient')
+    if stay:
+        patients = patients.filter(**stay)
+    return patients.distinct()
+
+
+def write_json(path, data):
+    """
+    Replaces the file at path with data encoded as JSON, atomically, so
+    an interrupted write leaves the previous contents in place.
+    """
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temporary, path)
+
+
+def read_ranges(path):
+    """
+    :return: The filters and primary key ranges of the export started in
+             the output directory, or (None, None) if there is none.
+    """
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+        return checkpoint['filters'], [tuple(r) for r in checkpoint['ranges']]
+    except (IOError, OSError, ValueError, KeyError):
+        return None, None
+
+
+def read_checkpoint(path):
+    """
+    :return: The last exported primary key and the size of the export file
+             when it was written, or (None, 0) if there is no checkpoint.
+    """
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+        return checkpoint['last_pk'], checkpoint['offset']
+    except (IOError, OSError, ValueError, KeyError):
+        return None, 0
+
+
+def write_checkpoint(path, last_pk, offset):
+    write_json(path, {'last_pk': last_pk, 'offset': offset})
+
+
+def export_range(task):
+    """
+    Exports the patients whose primary keys fall in [first_pk, last_pk] to
+    one gzipped NDJSON file, resuming after the range's checkpoint if one
+    exists.
+    Every chunk is written as its own gzip member and followed by a
+    checkpoint recording the file size. On resume the file is truncated
+    back to that size, so a chunk interrupted half-way is not duplicated.
+    :return: A tuple of the number of patients exported and the seconds
+             spent exporting them.
+    """
+    output, first_pk, last_pk, filters, chunk_size = task
+    name = os.path.join(output, 'patients-%d-%d.ndjson.gz' % (first_pk, last_pk))
+    checkpoint_path = name + '.checkpoint'
+    after, offset = read_checkpoint(checkpoint_path)
+    if after is None:
+        after = first_pk - 1
+    if after >= last_pk:
+        return 0, 0.0
+
+    started = time.time()
+    exported = 0
+    queryset = patient_queryset(**filters).filter(pk__lte=last_pk)
+    with open(name, 'ab') as f:
+        f.truncate(offset)
+        f.seek(offset)
+        for chunk in export_chunks(queryset, after=after, chunk_size=chunk_size):
+            data = ''.join(ndjson_line(user) for user in chunk)
+            f.write(gzip.compress(data.encode('utf-8')))
+            f.flush()
+            os.fsync(f.fileno())
+            exported += len(chunk)
+            write_checkpoint(checkpoint_path, chunk[-1].pk, f.tell())
+    write_checkpoint(checkpoint_path, last_pk, os.path.getsize(name))
+    return exported, time.time() - started
+
+
+class Command(BaseCommand):
+    help = ('Exports patient records to gzipped newline-delimited JSON files, '
+            'one per primary key range. Re-running the command resumes '
+            'from the last checkpoint.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('output',
+                            help='Directory to write the export files to.')
+        parser.add_argument('--hospital', type=int,
+                            help='Only export patients currently admitted to '
+                                 'the hospital with this id.')
+        parser.add_argument('--admitted-after',
+                            help='Only export patients with a stay admitted '
+                                 'on or after this date (YYYY-MM-DD). With '
+                                 '--hospital, the current stay there.')
+        parser.add_argument('--admitted-before',
+                            help='Only export patients with a stay admitted '
+                                 'before this date (YYYY-MM-DD). With both '
+                                 'dates, the same stay must match both.')
+        parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE,
+                            help='Patients loaded and written per batch.')
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of processes to split the export '
+                                 'across. A resumed export keeps the ranges '
+                                 'it started with.')
+
+    def parse_date(self, value, option):
+        if value is None:
+            return None
+        date = dateparse.parse_date(value)
+        if date is None:
+            raise CommandError('Invalid date for %s: %s' % (option, value))
+        return date
+
+    def handle(self, *args, **options):
+        output = options['output']
+        workers = max(options['workers'], 1)
+        filters = {
+            'hospital': options['hospital'],
+            'admitted_after': self.parse_date(options['admitted_after'],
+                                              '--admitted-after'),
+            'admitted_before': self.parse_date(options['admitted_before'],
+                                               '--admitted-before'),
+        }
+        if not os.path.isdir(output):
+            os.makedirs(output)
+
+        # The ranges are recorded when an export starts and reused when it
+        # is resumed, so patients added in between neither shift the ranges
+        # away from their checkpoints nor join a half-finished export.
+        ranges_path = os.path.join(output, RANGES_CHECKPOINT)
+        recorded = {name: options[name] for name in filters}
+        previous, ranges = read_ranges(ranges_path)
+        if ranges is not None and previous != recorded:
+            raise CommandError('%s holds an export with different filters; '
+                               'export to a new directory.' % output)
+        if ranges is None:
+            bounds = patient_queryset(**filters).aggregate(first=Min('pk'),
+                                                           last=Max('pk'))
+            if bounds['first'] is None:
+                self.stdout.write('No patients match the given filters.')
+                return
+            # Split the primary key space into one contiguous range per
+            # worker.
+            first, last = bounds['first'], bounds['last']
+            span = (last - first) // workers + 1
+            ranges = [(start, min(start + span - 1, last))
+                      for start in range(first, last + 1, span)]
+            write_json(ranges_path, {'filters': recorded, 'ranges': ranges})
+        tasks = [(output, start, end, filters, options['chunk_size'])
+                 for start, end in ranges]
+
+        started = time.time()
+        if workers == 1:
+            results = [export_range(task) for task in tasks]
+        else:
+            # Forked workers must not share the parent's connections.
+            for connection in connections.all():
+                connection.close()
+            pool = multiprocessing.Pool(workers)
+            try:
+                results = pool.map(export_range, tasks)
+            finally:
+                pool.close()
+                pool.join()
+        elapsed = time.time() - started
+
+        for (_, start, end, _, _), (count, seconds) in zip(tasks, results):
+            if count:
+                self.stdout.write('  ids %d-%d: %d patients in %.1fs'
+                                  % (start, end, count, seconds))
+        exported = sum(count for count, _ in results)
+        rate = exported / elapsed if elapsed else 0.0
+        self.stdout.write('Exported %d patient%s in %.1fs (%.0f patients/s) '
+                          'to %s.' % (exported, '' if exported == 1 else 's',
+                                      elapsed, rate, output))
@@ -0,0 +1,101 @@
+from django.core.management.base import BaseCommand, CommandError
+# activitylog is imported for its signal receivers.
+from health import activitylog, auditlog, signals
+from health.models import *
+import csv
+import time
+
+ACTIONS = ('admit', 'transfer', 'discharge')
+
+
+class Command(BaseCommand):
+    help = ('Applies admissions, transfers and discharges from a CSV file '
+            'with the columns user, hospital and action (admit, transfer '
+            'or discharge). Moves are applied in file order, batching '
+            'consecutive rows with the same hospital and action.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv_file', help='Path to the CSV file of moves.')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Users moved per transaction.')
+
+    def read_moves(self, path):
+        """
+        Reads the moves, grouping consecutive rows with the same hospital
+        and action into one run. Runs are applied in file order, so a user
+        moved twice ends up where the last row says.
+        :return: A list of (hospital id, action, user ids) runs.
+        """
+        runs = []
+        with open(path) as f:
+            for line, row in enumerate(csv.DictReader(f), start=2):
+                try:
+                    user = int(row['user'])
+                    hospital = int(row['hospital'])
+                    action = row['action'].strip().lower()
+                except (AttributeError, KeyError, TypeError, ValueError):
+                    raise CommandError('Invalid row on line %d.' % line)
+                if action not in ACTIONS:
+                    raise CommandError('Unknown action "%s" on line %d.'
+                                       % (action, line))
+                if action == 'transfer':
+                    # Admitting closes the previous stay, so a transfer is
+                    # just an admission to the new hospital.
+                    action = 'admit'
+                if runs and runs[-1][:2] == (hospital, action):
+                    runs[-1][2].append(user)
+                else:
+                    runs.append((hospital, action, [user]))
+        return runs
+
+    def check_exist(self, model, pks, name):
+        """
+        Raises a CommandError naming the primary keys with no row, so a
+        file with a typo is rejected before anything is moved.
+        """
+        pks = sorted(pks)
+        found = set()
+        # Chunked to stay under SQLite's limit on query parameters.
+        for start in range(0, len(pks), 500):
+            found.update(model.objects.filter(pk__in=pks[start:start + 500])
+                                      .values_list('pk', flat=True))
+        missing = [pk for pk in pks if pk not in found]
+        if missing:
+            raise CommandError('Unknown %s%s: %s' % (
+                name, '' if len(missing) == 1 else 's',
+                ', '.join(str(pk) for pk in missing)))
+
+    def handle(self, *args, **options):
+        runs = self.read_moves(options['csv_file'])
+        batch_size = max(options['batch_size'], 1)
+        self.check_exist(Hospital, {pk for pk, _, _ in runs}, 'hospital')
+        self.check_exist(User, {pk for _, _, users in runs for pk in users},
+                         'user')
+        hospitals = Hospital.objects.in_bulk({pk for pk, _, _ in runs})
+
+        started = time.time()
+        moved = 0
+        for hospital_pk, action, users in runs:
+            hospital = hospitals[hospital_pk]
+            for start in range(0, len(users), batch_size):
+                batch = users[start:start + batch_size]
+                if action == 'admit':
+                    hospital.admit_many(batch)
+                    for user in User.objects.filter(pk__in=batch):
+                        signals.patient_admitted.send(
+                            User, user=None, patient=user, hospital=hospital)
+                    moved += len(set(batch))
+                else:
+                    # Users not admitted here are not discharged, and get
+                    # no event.
+                    discharged = hospital.discharge_many(batch)
+                    if discharged:
+                        signals.patients_discharged.send(
+                            User, user=None, patients=discharged,
+                            hospital=hospital)
+                    moved += len(discharged)
+        auditlog.flush()
+        elapsed = time.time() - started
+        rate = moved / elapsed if elapsed else 0.0
+        self.stdout.write('Applied %d move%s in %.1fs (%.0f moves/s).'
+                          % (moved, '' if moved == 1 else 's', elapsed, rate))
@@ -1,12 +1,37 @@
 from django.core.management.base import BaseCommand
 from health.models import *
+from health import synthetic
 from django.contrib.auth.models import Group
 import datetime
+import time
 
 
 class Command(BaseCommand):
-    args = '<foo bar ...>'
-    help = 'our help string comes here'
+    help = ('Creates the demo hospitals and users, and optionally a large '
+            'synthetic dataset, e.g. --patients 500000 --doctors 2000. '
+            'The same --seed always generates the same data; run it on an '
+            'empty database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patients', type=int, default=0,
+                            help='Synthetic patients to generate.')
+        parser.add_argument('--doctors', type=int, default=20,
+                            help='Synthetic doctors to generate.')
+        parser.add_argument('--nurses', type=int, default=10,
+                            help='Synthetic nurses to generate.')
+        parser.add_argument('--hospitals', type=int, default=3,
+                            help='Synthetic hospitals to spread users over.')
+        parser.add_argument('--appointments-per-patient', type=int, default=2)
+        parser.add_argument('--prescriptions-per-patient', type=int, default=2)
+        parser.add_argument('--messages-per-group', type=int, default=10,
+                            help='Messages in each patient\'s conversation.')
+        parser.add_argument('--chunk-size', type=int,
+                            default=synthetic.CHUNK_SIZE,
+                            help='Users created per transaction.')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Seed for the random generator.')
+        parser.add_argument('--no-demo', action='store_false', dest='demo',
+                            help='Skip the hand-written demo users.')
 
     def _create_users(self):
         """
@@ -25,9 +50,9 @@ class Command(BaseCommand):
                                      address="1000 South Ave", state="New York", city="Rochester",
                                      zipcode="14620")
 
-        patients = Group.objects.create(name="Patient")
-        doctors = Group.objects.create(name="Doctor")
-        nurses = Group.objects.create(name="Nurse")
+        patients = Group.objects.get_or_create(name="Patient")[0]
+        doctors = Group.objects.get_or_create(name="Doctor")[0]
+        nurses = Group.objects.get_or_create(name="Nurse")[0]
 
         email = "admin@djangomaintained.com"
         admin = User.objects.create_superuser('admin', email=email, first_name="Administrator",
@@ -77,5 +102,28 @@ class Command(BaseCommand):
         patients.user_set.add(patient)
         h.admit(patient)
 
+    def _generate(self, options):
+        started = time.time()
+
+        def progress(role, done, total):
+            elapsed = time.time() - started
+            self.stdout.write('%s: %d/%d (%.0fs elapsed)'
+                              % (role, done, total, elapsed))
+
+        generator = synthetic.Generator(seed=options['seed'])
+        generator.generate(
+            hospitals=max(options['hospitals'], 1),
+            doctors=options['doctors'], nurses=options['nurses'],
+            patients=options['patients'],
+            appointments_per_patient=options['appointments_per_patient'],
+            prescriptions_per_patient=options['prescriptions_per_patient'],
+            messages_per_group=options['messages_per_group'],
+            chunk_size=max(options['chunk_size'], 1), progress=progress)
+        self.stdout.write('Generated %d patients in %.1fs.'
+                          % (options['patients'], time.time() - started))
+
     def handle(self, *args, **options):
-        self._create_users()
+        if options['demo']:
+            self._create_users()
+        if options['patients']:
+            self._generate(options)
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from health.models import *
+
+
+class Command(BaseCommand):
+    help = 'Points every user\'s current_stay at their open hospital stay.'
+
+    def handle(self, *args, **options):
+        open_stays = dict(HospitalStay.objects
+                          .filter(discharge__isnull=True)
+                          .order_by('admission', 'pk')
+                          .values_list('patient', 'pk'))
+        updated = 0
+        with transaction.atomic():
+            for pk, current in User.objects.values_list('pk', 'current_stay'):
+                stay = open_stays.get(pk)
+                if stay != current:
+                    User.objects.filter(pk=pk).update(current_stay=stay)
+                    updated += 1
+        self.stdout.write('Rebuilt current stays; %d user%s changed.'
+                          % (updated, '' if updated == 1 else 's'))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F
+from health.models import *
+
+
+class Command(BaseCommand):
+    help = 'Recomputes every user\'s unread message counter from the read receipts.'
+
+    def handle(self, *args, **options):
+        # Messages in every group each user belongs to.
+        totals = dict(MessageGroup.members.through.objects
+                      .values('user')
+                      .annotate(count=Count('messagegroup__messages'))
+                      .values_list('user', 'count'))
+        # Of those, the ones the user has read.
+        read = dict(Message.read_members.through.objects
+                    .filter(message__group__members=F('user'))
+                    .values('user')
+                    .annotate(count=Count('pk'))
+                    .values_list('user', 'count'))
+        updated = 0
+        with transaction.atomic():
+            for pk, current in User.objects.values_list('pk', 'unread_messages'):
+                unread = max(totals.get(pk, 0) - read.get(pk, 0), 0)
+                if unread != current:
+                    User.objects.filter(pk=pk).update(unread_messages=unread)
+                    updated += 1
+        self.stdout.write('Rebuilt unread counts; %d user%s changed.'
+                          % (updated, '' if updated == 1 else 's'))
@@ -1,9 +1,38 @@
-from django.db import models
-from django.db.models import Q
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, models, transaction
+from django.db.models import Case, Count, F, Max, Q, Value, When
+from django.db.models.signals import m2m_changed, post_migrate
+from django.dispatch import receiver
 from django.utils import timezone
+from django.utils.functional import cached_property
 from datetime import timedelta
+from functools import reduce
+import itertools
+import json
+import operator
+from .pagination import keyset_page, ordered_page
 from django.contrib.auth.models import AbstractUser, Group
 
+INBOX_PAGE_SIZE = 25
+ROSTER_GROUPS = ('Doctor', 'Nurse', 'Patient')
+# Seconds a hospital's rosters are cached for; 0 disables the cache. They
+# are only cached when the SHARED_CACHE setting says every worker shares
+# the cache, since clearing a per-process cache misses the other workers.
+ROSTER_CACHE_TTL = 300
+CONVERSATION_PAGE_SIZE = 50
+# Users moved per statement by Hospital.admit_many. Moving the current stay
+# pointers binds three parameters per user, which must stay under
+# SQLite's default limit of 999.
+ADMIT_CHUNK_SIZE = 300
+DIRECTORY_PAGE_SIZE = 50
+
+# Generations of the users whose groups changed through group.user_set.
+# Those changes reach the Group rather than the User instances caching
+# their group names, so group_names() compares generations instead.
+_group_generation = itertools.count(1)
+_user_group_generations = {}
+
 
 class Insurance(models.Model):
     policy_number = models.CharField(max_length=200)
@@ -95,37 +124,146 @@ class Hospital(models.Model):
 
     def __repr__(self):
         # "St. Jude Hospital at 1 Hospital Road, Waterbury, CT 06470"
-        return ("%s at %s, %s, %s %s" % self.name, self.address, self.city,
-                self.state, self.zipcode)
+        return "%s at %s, %s, %s %s" % (self.name, self.address, self.city,
+                                        self.state, self.zipcode)
 
     def __str__(self):
         return "{0} with {1}".format(self.name, self.address)
 
     def admit(self, user):
-        current_hospital_query = HospitalStay.objects.filter(patient=user,
-                                                             discharge__isnull=True)
-        if current_hospital_query.exists():
-            for stay in current_hospital_query.all():
-                stay.discharge = timezone.now()
-                stay.save()
-        HospitalStay.objects.create(patient=user, admission=timezone.now(),
-                                    hospital=self)
+        """
+        Admits a user to this hospital, closing any stay they currently
+        have open elsewhere.
+        """
+        with transaction.atomic():
+            HospitalStay.objects.filter(patient=user, discharge__isnull=True)\
+                                .update(discharge=timezone.now())
+            stay = HospitalStay.objects.create(patient=user,
+                                               admission=timezone.now(),
+                                               hospital=self)
+            user.set_current_stay(stay)
+        Hospital.clear_roster_cache(self.pk)
 
     def discharge(self, user):
-        user_query = HospitalStay.objects.filter(patient=user,
-                                                 hospital=self)
-        if user_query.exists():
-            stay = user_query.first()
-            stay.discharge = timezone.now()
-            stay.save()
+        """
+        Closes the user's open stay at this hospital, if they have one.
+        """
+        self.discharge_many([user])
+        if user.current_stay_id and user.hospital() == self:
+            user.set_current_stay(None, save=False)
+
+    def admit_many(self, users):
+        """
+        Admits (or transfers) many users to this hospital at once.
+        Any stays the users have open are closed with one update, the new
+        stays are inserted with one bulk insert, and the users' current
+        stay pointers are moved with one more update, all in a single
+        transaction. Larger batches are split into ADMIT_CHUNK_SIZE users
+        per statement.
+        :param users: Users or user primary keys.
+        :return: The number of users admitted.
+        """
+        pks = list({getattr(user, 'pk', user) for user in users})
+        if not pks:
+            return 0
+        now = timezone.now()
+        with transaction.atomic():
+            for start in range(0, len(pks), ADMIT_CHUNK_SIZE):
+                chunk = pks[start:start + ADMIT_CHUNK_SIZE]
+                HospitalStay.objects.filter(patient__in=chunk,
+                                            discharge__isnull=True)\
+                                    .update(discharge=now)
+                HospitalStay.objects.bulk_create([
+                    HospitalStay(patient_id=pk, hospital=self, admission=now)
+                    for pk in chunk])
+                # bulk_create does not return primary keys on every
+                # backend, so read the new stays back.
+                stays = HospitalStay.objects.filter(
+                    patient__in=chunk, hospital=self, admission=now,
+                    discharge__isnull=True).values_list('patient', 'pk')
+                User.objects.filter(pk__in=chunk).update(current_stay=Case(
+                    *[When(pk=patient, then=Value(stay))
+                      for patient, stay in stays],
+                    output_field=models.IntegerField()))
+        Hospital.clear_roster_cache(self.pk)
+        return len(pks)
+
+    def discharge_many(self, users):
+        """
+        Discharges many users from this hospital at once: their open stays
+        here are locked and read, then closed with one update, and their
+        current stay pointers are cleared with one more.
+        :param users: Users or user primary keys.
+        :return: The primary keys of the users discharged, those who had an
+                 open stay here, in ascending order.
+        """
+        pks = list({getattr(user, 'pk', user) for user in users})
+        if not pks:
+            return []
+        with transaction.atomic():
+            discharged = sorted(set(
+                HospitalStay.objects.select_for_update()
+                            .filter(patient__in=pks, hospital=self,
+                                    discharge__isnull=True)
+                            .values_list('patient', flat=True)))
+            if not discharged:
+                return []
+            User.objects.filter(pk__in=discharged, current_stay__hospital=self)\
+                        .update(current_stay=None)
+            HospitalStay.objects.filter(patient__in=discharged, hospital=self,
+                                        discharge__isnull=True)\
+                                .update(discharge=timezone.now())
+        Hospital.clear_roster_cache(self.pk)
+        return discharged
 
     def users_in_group(self, group_name):
-        return list({stay.patient for stay in
-                     HospitalStay.objects
-                     .filter(hospital=self, patient__groups__name=group_name)
-                     .distinct()
-                     .order_by('patient__first_name', 'patient__last_name')
-                     .all()})
+        return self.rosters().get(group_name, [])
+
+    def rosters(self):
+        """
+        Returns every user who has stayed at this hospital, grouped by role
+        and ordered by name.
+        The rosters are built from a single query over group memberships.
+        With a shared cache, the members' primary keys are cached for
+        ROSTER_CACHE_TTL seconds and admit, discharge and group changes
+        clear them; the users themselves are always loaded fresh, with one
+        query, so name changes and deactivations show up at once.
+        :return: A dictionary mapping 'Doctor', 'Nurse' and 'Patient' to
+                 lists of users.
+        """
+        key = self.roster_cache_key(self.pk)
+        cached = ROSTER_CACHE_TTL and getattr(settings, 'SHARED_CACHE', False)
+        members = cache.get(key) if cached else None
+        if members is not None:
+            users = User.objects.in_bulk(
+                {pk for pks in members.values() for pk in pks})
+            order = operator.attrgetter('first_name', 'last_name', 'pk')
+            return {name: sorted((users[pk] for pk in members.get(name, ())
+                                  if pk in users), key=order)
+                    for name in ROSTER_GROUPS}
+        rosters = {name: [] for name in ROSTER_GROUPS}
+        memberships = (User.groups.through.objects
+                       .filter(group__name__in=ROSTER_GROUPS,
+                               user__hospitalstay__hospital=self)
+                       .select_related('user', 'group')
+                       .order_by('user__first_name', 'user__last_name',
+                                 'user__pk')
+                       .distinct())
+        for membership in memberships:
+            rosters[membership.group.name].append(membership.user)
+        if cached:
+            cache.set(key, {name: [user.pk for user in users]
+                            for name, users in rosters.items()},
+                      ROSTER_CACHE_TTL)
+        return rosters
+
+    @staticmethod
+    def roster_cache_key(pk):
+        return 'hospital-rosters:%s' % pk
+
+    @classmethod
+    def clear_roster_cache(cls, *pks):
+        cache.delete_many([cls.roster_cache_key(pk) for pk in pks])
 
 
 class User(AbstractUser):
@@ -134,10 +272,29 @@ class User(AbstractUser):
     medical_information = models.ForeignKey(MedicalInformation, null=True)
     emergency_contact = models.ForeignKey(EmergencyContact, null=True)
     thumbnail = models.URLField(null=True, blank=True)
+    # The open HospitalStay, if any. Maintained by Hospital.admit and
+    # Hospital.discharge so the current hospital is one indexed lookup.
+    current_stay = models.ForeignKey('HospitalStay', null=True, blank=True,
+                                     related_name='+',
+                                     on_delete=models.SET_NULL)
+    # Denormalized count of unread messages, maintained by
+    # MessageGroup.post and MessageGroup.mark_read. Rebuild it with
+    # the rebuild_unread_counts management command.
+    unread_messages = models.PositiveIntegerField(default=0)
 
     REQUIRED_FIELDS = ['date_of_birth', 'phone_number', 'email', 'first_name',
                        'last_name']
 
+    # Per-instance cache of group names, populated by group_names().
+    _group_names = None
+    _group_names_generation = None
+
+    class Meta(AbstractUser.Meta):
+        index_together = [
+            # Alphabetical patient directory; see patient_directory().
+            ('last_name', 'first_name'),
+        ]
+
     def __str__(self):
         return " {0}".format(self.first_name)
 
@@ -152,12 +309,16 @@ class User(AbstractUser):
             Returns all patients in the database.
         :return:
         """
+        patients = User.objects.filter(groups__name='Patient')
         if self.is_superuser or self.is_doctor():
             # Admins and doctors can see all users as patients.
-            return Group.objects.get(name='Patient').user_set.all()
+            return patients
         elif self.is_nurse():
-            # Nurses get all users inside their hospital.
-            return Group.objects.get(name='Patient').user_set.filter(hospital=self.hospital)
+            # Nurses get all patients currently admitted to their hospital.
+            hospital = self.hospital()
+            if hospital is None:
+                return User.objects.none()
+            return patients.filter(current_stay__hospital=hospital)
         else:
             # Users can only see themselves.
             return User.objects.filter(pk=self.pk)
@@ -167,7 +328,8 @@ class User(AbstractUser):
             or self.is_superuser \
             or user.is_patient() \
             and self.is_doctor() or (self.is_nurse()
-                                     and self.hospital == user.hospital)
+                                     and self.hospital() is not None
+                                     and self.hospital() == user.hospital())
 
     def active_patients(self):
         """
@@ -176,13 +338,103 @@ class User(AbstractUser):
         """
         return self.all_patients().filter(is_active=True)
 
+    def directory_queryset(self, prefix=None):
+        """
+        The active patients this user may see, optionally narrowed to
+        those whose first or last name starts with prefix. On PostgreSQL
+        the prefix match is served by the indexes created by
+        create_name_prefix_indexes.
+        """
+        patients = self.active_patients()
+        if prefix:
+            patients = patients.filter(Q(last_name__istartswith=prefix) |
+                                       Q(first_name__istartswith=prefix))
+        return patients
+
+    def patient_directory(self, prefix=None, cursor=None,
+                          limit=DIRECTORY_PAGE_SIZE, queryset=None):
+        """
+        Returns one page of the active patients this user may see, in
+        alphabetical order by last and then first name.
+        Pages are keyed on (last_name, first_name, id), which the index on
+        (last_name, first_name) covers, so every page costs the same
+        however far into the directory it is.
+        :param prefix: If given, only patients whose first or last name
+                       starts with it are listed.
+        :param cursor: The cursor returned for the previous page, if any.
+        :param queryset: Optionally, directory_queryset(prefix) with extra
+                         select_related/prefetch_related applied.
+        :return: A tuple of the patients on the page and the cursor for
+                 the next page (None on the last page).
+        """
+        if queryset is None:
+            queryset = self.directory_queryset(prefix)
+        return ordered_page(queryset, ('last_name', 'first_name'),
+                            cursor=cursor, limit=limit)
+
+    def active_prescriptions(self):
+        if hasattr(self, 'prefetched_active_prescriptions'):
+            return self.prefetched_active_prescriptions
+        return self.prescription_set.filter(active=True).all()
+
     def can_add_prescription(self):
         return self.is_superuser or self.is_doctor()
 
     def latest_messages(self):
         return self.sent_messages.order_by('-date')
 
+    def inbox(self, cursor=None, limit=INBOX_PAGE_SIZE):
+        """
+        Builds one page of the user's message groups, newest activity
+        first, in a constant number of queries regardless of how many
+        groups or messages there are.
+        Groups are paginated by keyset on (latest message date, id); groups
+        without any messages are left out.
+        Each group is annotated with:
+            max_date: the date of its latest message.
+            last_message: its latest Message, with the sender loaded.
+            unread_count: how many of its messages the user has not read.
+            has_unread: whether unread_count is non-zero.
+        Members are prefetched so combined_names() needs no extra queries.
+        :param cursor: The cursor returned for the previous page, if any.
+        :param limit: The maximum number of groups to return.
+        :return: A tuple of a list of MessageGroups and the cursor for the
+                 next page (None on the last page).
+        """
+        groups, next_cursor = keyset_page(
+            self.messagegroup_set
+                .annotate(max_date=Max('messages__date'))
+                .filter(max_date__isnull=False)
+                .prefetch_related('members'),
+            'max_date', cursor=cursor, limit=limit)
+        latest = {}
+        if groups:
+            latest_query = reduce(operator.or_, [Q(group=g.pk, date=g.max_date)
+                                                 for g in groups])
+            for message in (Message.objects.filter(latest_query)
+                                           .select_related('sender')
+                                           .order_by('pk')):
+                latest[message.group_id] = message
+        unread = dict(Message.objects
+                             .filter(group__in=[g.pk for g in groups])
+                             .exclude(read_members=self)
+                             .values('group')
+                             .annotate(count=Count('pk'))
+                             .values_list('group', 'count')) if groups else {}
+        for group in groups:
+            group.last_message = latest.get(group.pk)
+            group.unread_count = unread.get(group.pk, 0)
+            group.has_unread = group.unread_count > 0
+        return groups, next_cursor
+
     def unread_message_count(self):
+        return self.unread_messages
+
+    def count_unread_messages(self):
+        """
+        Counts the user's unread messages from scratch, rather than
+        reading the unread_messages counter.
+        """
         return Message.objects.filter(group__members__pk=self.pk)\
                               .exclude(read_members__pk=self.pk)\
                               .distinct().count()
@@ -199,11 +451,24 @@ class User(AbstractUser):
         # Patients see all appointments
         return Appointment.objects.filter(patient=self)
 
+    def activity_since(self, since, action=None):
+        """
+        :param since: The earliest time to include.
+        :param action: Only include events with this action, e.g.
+                       'prescription.added'.
+        :return: The user's activity events since a time, newest first.
+        """
+        events = self.activity.filter(time__gte=since)
+        if action:
+            events = events.filter(action=action)
+        return events.order_by('-time', '-pk')
+
     def upcoming_appointments(self):
         date = timezone.now()
         start_week = date - timedelta(date.weekday())
         end_week = start_week + timedelta(7)
-        return self.schedule().filter(date__range=[start_week, end_week])
+        return self.schedule().filter(date__range=[start_week, end_week])\
+                              .select_related('doctor', 'patient')
 
     def is_patient(self):
         """
@@ -228,36 +493,109 @@ class User(AbstractUser):
         :param group_name: The group within which to check membership.
         :return: True if the user is a member of the group provided.
         """
-        try:
-            return (Group.objects.get(name=group_name)
-                         .user_set.filter(pk=self.pk).exists())
-        except ValueError:
-            return False
+        return group_name in self.group_names()
+
+    def group_names(self):
+        """
+        Loads the names of every group this user belongs to with a single
+        query and caches them on the instance, so repeated role checks
+        during a request (is_patient, is_doctor, can_edit_user, ...) do
+        not hit the database again.
+        The cache is cleared whenever this user's groups change.
+        :return: A frozenset of group names.
+        """
+        generation = _user_group_generations.get(self.pk, 0)
+        if (self._group_names is None or
+                self._group_names_generation != generation):
+            self._group_names_generation = generation
+            if 'groups' in getattr(self, '_prefetched_objects_cache', {}):
+                self._group_names = frozenset(g.name for g in self.groups.all())
+                return self._group_names
+            try:
+                self._group_names = frozenset(
+                    self.groups.values_list('name', flat=True))
+            except ValueError:
+                # Unsaved users cannot have groups.
+                return frozenset()
+        return self._group_names
+
+    def clear_group_cache(self):
+        self._group_names = None
 
     def group(self):
         return self.groups.first()
 
-    def is_free(self, date, duration):
+    def is_free(self, date, duration, ignore=None):
         """
         Checks the user's schedule for a given date and duration to see if
         the user does not have an appointment at that time.
         :param date:
         :param duration:
+        :param ignore: An appointment to leave out of the check, e.g. the
+                       one being rescheduled.
         :return:
         """
-        schedule = self.schedule().all()
         end = date + timedelta(minutes=duration)
-        for appointment in schedule:
-            # If the dates intersect (meaning one starts while the other is
-            # in progress) then the person is not free at the provided date
-            # and time.
-            if (date <= appointment.date <= end or
-                    appointment.date <= date <= appointment.end()):
-                return False
-        return True
-
-    def active_prescriptions(self):
-        return self.prescription_set.filter(active=True).all()
+        # If the dates intersect (meaning one starts while the other is
+        # in progress) then the person is not free at the provided date
+        # and time.
+        conflicts = self.schedule().filter(date__lte=end, end_date__gte=date)
+        if ignore is not None and ignore.pk:
+            conflicts = conflicts.exclude(pk=ignore.pk)
+        return not conflicts.exists()
+
+    def free_slots(self, start, end, duration, step=None):
+        """
+        Finds every time between start and end at which an appointment
+        of the given duration could begin without conflicting with the
+        user's schedule. Uses a single range query over the appointments
+        that intersect the window.
+        :param start: The earliest datetime a slot may begin.
+        :param end: The latest datetime a slot may finish.
+        :param duration: The length of the desired appointment, in minutes.
+        :param step: Minutes between candidate start times. Defaults to
+                     the duration.
+        :return: A list of datetimes at which the user is free.
+        """
+        length = timedelta(minutes=duration)
+        step = timedelta(minutes=step or duration)
+        busy = list(self.schedule()
+                        .filter(date__lte=end, end_date__gte=start)
+                        .order_by('date')
+                        .values_list('date', 'end_date'))
+        slots = []
+        slot = start
+        index = 0
+        while slot + length <= end:
+            # Appointments that finished before this slot cannot
+            # conflict with it or with any later slot.
+            while index < len(busy) and busy[index][1] < slot:
+                index += 1
+            for busy_start, busy_end in busy[index:]:
+                if busy_start > slot + length:
+                    # Sorted by start, so nothing later overlaps either.
+                    slots.append(slot)
+                    break
+                if busy_end >= slot:
+                    break
+            else:
+                slots.append(slot)
+            slot += step
+        return slots
+
+    def all_appointments(self):
+        """
+        :return: A list of every appointment in the user's schedule, with
+                 the doctor and patient loaded. Uses the appointments
+                 prefetched by exports.export_queryset when present.
+        """
+        prefetched = getattr(self, '_prefetched_objects_cache', {})
+        if not self.is_superuser:
+            name = ('doctor_appointments' if self.is_doctor()
+                    else 'patient_appointments')
+            if name in prefetched:
+                return list(getattr(self, name).all())
+        return list(self.schedule().select_related('doctor', 'patient'))
 
     def json_object(self):
         json = {
@@ -266,34 +604,106 @@ class User(AbstractUser):
             'date_of_birth': self.date_of_birth.isoformat(),
             'phone_number': self.phone_number,
         }
-        if self.hospital:
-            json['hospital'] = self.hospital().json_object()
+        hospital = self.hospital()
+        if hospital:
+            json['hospital'] = hospital.json_object()
         if self.medical_information:
             json['medical_information'] = self.medical_information.json_object()
         if self.emergency_contact:
             json['emergency_contact'] = self.emergency_contact.json_object()
-        if self.prescription_set.all():
-            json['prescriptions'] = [p.json_object() for p in
-                                     self.prescription_set.all()]
-        if self.schedule():
-            json['appointments'] = [a.json_object()
-                                    for a in self.schedule().all()]
+        prescriptions = list(self.prescription_set.all())
+        if prescriptions:
+            json['prescriptions'] = [p.json_object() for p in prescriptions]
+        appointments = self.all_appointments()
+        if appointments:
+            json['appointments'] = [a.json_object() for a in appointments]
         return json
 
     def hospital(self):
-        patient_query = HospitalStay.objects.filter(patient=self,
-                                                    discharge__isnull=True)
-        if patient_query.exists():
-            stays = [x for x in patient_query.all()]
-            return stays[0].hospital
-        return None
+        return self.current_hospital
+
+    @cached_property
+    def current_hospital(self):
+        """
+        The hospital the user is currently admitted to, or None.
+        Costs no queries if current_stay__hospital was select_related,
+        otherwise a single primary key lookup, and is cached afterwards.
+        """
+        if self.current_stay_id is None:
+            return None
+        # Django caches a select_related foreign key under this name.
+        stay = getattr(self, '_current_stay_cache', None)
+        if stay is None:
+            stay = HospitalStay.objects.select_related('hospital')\
+                                       .get(pk=self.current_stay_id)
+            self.current_stay = stay
+        return stay.hospital
+
+    def set_current_stay(self, stay, save=True):
+        """
+        Points the user at a new open stay (or None when discharged) and,
+        unless save is False, saves just that column.
+        """
+        self.current_stay = stay
+        self.__dict__.pop('current_hospital', None)
+        if save:
+            User.objects.filter(pk=self.pk).update(current_stay=stay)
 
 
 class Appointment(models.Model):
     patient = models.ForeignKey(User, related_name='patient_appointments')
     doctor = models.ForeignKey(User, related_name='doctor_appointments')
-    date = models.DateTimeField()
+    date = models.DateTimeField(db_index=True)
     duration = models.IntegerField()
+    # Denormalized from date + duration so overlap checks can be a single
+    # indexed range query. Kept up to date in save().
+    end_date = models.DateTimeField(db_index=True, editable=False)
+    # Last time the appointment was saved; drives calendar feed caching.
+    modified = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        # Every schedule is one person's appointments ordered by date.
+        index_together = [
+            ('doctor', 'date'),
+            ('patient', 'date'),
+        ]
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        appointment = super(Appointment, cls).from_db(db, field_names, values)
+        # Remember where the appointment was stored, so moving it can
+        # free the doctor's old slots in the availability grid.
+        appointment._stored = (appointment.__dict__.get('doctor_id'),
+                               appointment.__dict__.get('date'),
+                               appointment.__dict__.get('end_date'))
+        return appointment
+
+    def save(self, *args, **kwargs):
+        self.end_date = self.end()
+        with transaction.atomic():
+            super(Appointment, self).save(*args, **kwargs)
+            self.update_availability()
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            super(Appointment, self).delete(*args, **kwargs)
+            self.update_availability()
+
+    def update_availability(self):
+        """
+        Refreshes the doctor's precomputed availability for the days the
+        appointment used to occupy and the days it occupies now.
+        Queryset updates and deletes bypass this; rebuild the grid with
+        the build_availability command after those.
+        """
+        from . import availability
+        stored = getattr(self, '_stored', None)
+        if stored and None not in stored:
+            availability.appointment_changed(*stored)
+        if self.pk is not None:
+            availability.appointment_changed(self.doctor_id, self.date,
+                                             self.end_date)
+            self._stored = (self.doctor_id, self.date, self.end_date)
 
     def json_object(self):
         return {
@@ -317,6 +727,27 @@ class Appointment(models.Model):
         return " {0} appionment with {1}".format(self.patient, self.doctor)
 
 
+class DoctorAvailability(models.Model):
+    """
+    A doctor's precomputed busy slots for one local calendar day, kept for
+    a rolling window of days so the booking form can show a week of
+    availability for a whole hospital with a single read.
+    See availability.py for the slot layout.
+    """
+    doctor = models.ForeignKey(User, related_name='availability')
+    day = models.DateField()
+    # Bitmap with one bit per slot of the day, least significant bit
+    # first; a set bit means the doctor has an appointment in that slot.
+    busy = models.BinaryField()
+
+    class Meta:
+        unique_together = ('doctor', 'day')
+        index_together = [('day', 'doctor')]
+
+    def __str__(self):
+        return "Availability of {0} on {1}".format(self.doctor, self.day)
+
+
 class HospitalStay(models.Model):
     patient = models.ForeignKey(User)
     admission = models.DateTimeField()
@@ -360,6 +791,78 @@ class MessageGroup(models.Model):
             return None
         return self.messages.order_by('-date').first()
 
+    def post(self, sender, body):
+        """
+        Sends a message to this group. The message counts as read by its
+        sender and bumps every other member's unread counter.
+        :return: The new Message.
+        """
+        with transaction.atomic():
+            message = Message.objects.create(sender=sender, group=self,
+                                             body=body, date=timezone.now())
+            message.read_members.add(sender)
+            User.objects.filter(messagegroup=self)\
+                        .exclude(pk=sender.pk)\
+                        .update(unread_messages=F('unread_messages') + 1)
+        return message
+
+    def messages_page(self, cursor=None, limit=CONVERSATION_PAGE_SIZE):
+        """
+        Returns one page of this group's messages, newest first, with
+        senders loaded. Pages are keyed on (date, id), so loading older
+        messages costs the same however long the thread is.
+        :return: A tuple of the messages and the cursor for older messages
+                 (None if there are none).
+        """
+        return keyset_page(self.messages.select_related('sender'), 'date',
+                           cursor=cursor, limit=limit)
+
+    def mark_read(self, user, up_to=None):
+        """
+        Marks every message in this group up to and including the message
+        with primary key up_to as read by the user.
+        Only messages newer than the user's read marker are considered, and
+        the missing read receipts are inserted with a single bulk insert
+        while the marker is locked.
+        :param user: The member who read the messages.
+        :param up_to: The primary key of the newest message read. Defaults
+                      to the latest message in the group.
+        :return: The number of messages newly marked as read.
+        """
+        if up_to is None:
+            up_to = self.messages.aggregate(last=Max('pk'))['last']
+            if up_to is None:
+                return 0
+        marker, _ = MessageReadMarker.objects.get_or_create(group=self,
+                                                            user=user)
+        if marker.last_read_id >= up_to:
+            return 0
+        receipt = Message.read_members.through
+        with transaction.atomic():
+            # Lock the marker so concurrent calls for the same user wait
+            # for each other instead of inserting the same receipts twice.
+            marker = MessageReadMarker.objects.select_for_update()\
+                                              .get(pk=marker.pk)
+            if marker.last_read_id >= up_to:
+                return 0
+            unread = (self.messages
+                          .filter(pk__gt=marker.last_read_id, pk__lte=up_to)
+                          .exclude(read_members=user)
+                          .values_list('pk', flat=True))
+            receipts = [receipt(message_id=pk, user_id=user.pk)
+                        for pk in unread]
+            receipt.objects.bulk_create(receipts)
+            MessageReadMarker.objects.filter(pk=marker.pk,
+                                             last_read_id__lt=up_to)\
+                                     .update(last_read_id=up_to)
+            if receipts:
+                read = len(receipts)
+                User.objects.filter(pk=user.pk).update(unread_messages=Case(
+                    When(unread_messages__gt=read,
+                         then=F('unread_messages') - read),
+                    default=Value(0)))
+        return len(receipts)
+
     def combined_names(self, full=False):
         names_count = self.members.count()
         extras = names_count - 3
@@ -379,10 +882,80 @@ class Message(models.Model):
     date = models.DateTimeField()
     read_members = models.ManyToManyField(User, related_name='read_messages')
 
+    def json_object(self):
+        return {
+            'id': self.pk,
+            'sender': self.sender.get_full_name(),
+            'sender_id': self.sender_id,
+            'body': self.body,
+            'date': self.date.isoformat(),
+        }
+
     def preview_text(self):
         return (self.body[:100] + "...") if len(self.body) > 100 else self.body
 
 
+class MessageReadMarker(models.Model):
+    """
+    Records the newest message a member has read in a group, so marking a
+    conversation as read only has to look at messages after it.
+    """
+    group = models.ForeignKey(MessageGroup, related_name='read_markers')
+    user = models.ForeignKey(User, related_name='read_markers')
+    last_read_id = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('group', 'user')
+
+    def __str__(self):
+        return "{0} read {1} up to {2}".format(self.user, self.group,
+                                               self.last_read_id)
+
+
+class PatientSearchDocument(models.Model):
+    """
+    The searchable text for a user: names, email, phone and medical
+    information, flattened into one column so it can be covered by a
+    full-text or trigram index. Kept up to date by search.index_user.
+    """
+    user = models.OneToOneField(User, primary_key=True,
+                                related_name='search_document')
+    document = models.TextField()
+
+    def __str__(self):
+        return "Search document for {0}".format(self.user_id)
+
+
+class ActivityEvent(models.Model):
+    """
+    One thing a user did, recorded from the domain signals in signals.py
+    by activitylog.py.
+    """
+    # The user who acted, or None for system actions such as imports.
+    user = models.ForeignKey(User, null=True, related_name='activity')
+    # A dotted name such as 'prescription.added'.
+    action = models.CharField(max_length=50)
+    time = models.DateTimeField(default=timezone.now)
+    # Primary key of the object acted on, if any.
+    object_id = models.PositiveIntegerField(null=True)
+    # The details of the event as a JSON object.
+    payload = models.TextField(default='{}')
+
+    class Meta:
+        # A user's activity is read newest first, optionally for one
+        # action, over a period of time.
+        index_together = [
+            ('user', 'time'),
+            ('user', 'action', 'time'),
+        ]
+
+    def data(self):
+        return json.loads(self.payload)
+
+    def __str__(self):
+        return "{0} {1} at {2}".format(self.user, self.action, self.time)
+
+
 class Subscription(models.Model):
 
     email = models.CharField(max_length=200)
@@ -403,3 +976,55 @@ class Contact(models.Model):
     def __str__(self):
         """Unicode representation of Subscription."""
         return "{0} for {1}".format(self.first_name, self.last_name)
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+def clear_user_group_cache(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Invalidates the cached group names of users whose groups changed.
+    When the change is made through group.user_set the instance is the
+    Group, so the affected users are marked stale by primary key and
+    every instance of them reloads its group names on the next check.
+    Also clears the rosters of every hospital the affected users stayed at.
+    """
+    if action == 'pre_clear' and reverse:
+        # The members are gone by post_clear, so note them now.
+        instance._cleared_user_pks = list(
+            instance.user_set.values_list('pk', flat=True))
+        return
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if not reverse:
+        instance.clear_group_cache()
+        users = [instance.pk]
+    else:
+        if pk_set is not None:
+            users = pk_set
+        else:
+            users = instance.__dict__.pop('_cleared_user_pks', [])
+        generation = next(_group_generation)
+        for pk in users:
+            _user_group_generations[pk] = generation
+    Hospital.clear_roster_cache(*set(
+        HospitalStay.objects.filter(patient__in=users)
+                            .values_list('hospital', flat=True)))
+
+
+@receiver(post_migrate)
+def create_name_prefix_indexes(sender, using='default', **kwargs):
+    """
+    Case-insensitive prefix filters (name__istartswith) compile to
+    UPPER(name) LIKE 'PREFIX%' on PostgreSQL, which the plain
+    (last_name, first_name) index cannot serve. Django 1.8 cannot declare
+    expression indexes, so they are created here after every migrate.
+    """
+    connection = connections[using]
+    if sender.label != User._meta.app_label or \
+            connection.vendor != 'postgresql':
+        return
+    table = User._meta.db_table
+    with connection.cursor() as cursor:
+        for column in ('last_name', 'first_name'):
+            cursor.execute(
+                'CREATE INDEX IF NOT EXISTS {0}_{1}_upper_like ON {0} '
+                '(UPPER({1}::text) text_pattern_ops)'.format(table, column))
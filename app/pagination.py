@@ -0,0 +1,118 @@
+import base64
+import datetime
+import json
+from django.db.models import Q
+from django.utils import timezone
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def encode_cursor(date, pk):
+    """
+    Encodes a (date, primary key) position as an opaque, URL-safe string.
+    The date is stored as whole microseconds since the epoch so the cursor
+    round-trips exactly.
+    """
+    delta = date - EPOCH
+    micros = (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds
+    return "%d-%d" % (micros, pk)
+
+
+def decode_cursor(cursor):
+    """
+    Reverses encode_cursor.
+    :return: A (date, primary key) tuple, or None if the cursor is invalid.
+    """
+    try:
+        micros, pk = cursor.rsplit('-', 1)
+        return EPOCH + datetime.timedelta(microseconds=int(micros)), int(pk)
+    except (AttributeError, ValueError, OverflowError):
+        return None
+
+
+def keyset_page(queryset, field, cursor=None, limit=50):
+    """
+    Returns one page of a queryset ordered newest first by (field, pk).
+    Instead of an OFFSET, the page starts strictly after the position in
+    the cursor, so fetching any page costs the same no matter how deep it
+    is.
+    :param queryset: The queryset to paginate. field may be an annotation.
+    :param field: The name of the date field to order by.
+    :param cursor: A cursor returned by a previous call, or None for the
+                   first page.
+    :param limit: The maximum number of items on the page.
+    :return: A tuple of the items on the page and the cursor for the next
+             page, or None if this is the last page.
+    """
+    queryset = queryset.order_by('-' + field, '-pk')
+    position = decode_cursor(cursor) if cursor else None
+    if position:
+        date, pk = position
+        queryset = queryset.filter(Q(**{field + '__lt': date}) |
+                                   Q(**{field: date, 'pk__lt': pk}))
+    items = list(queryset[:limit + 1])
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        next_cursor = encode_cursor(getattr(last, field), last.pk)
+    return items, next_cursor
+
+
+def encode_values(values):
+    """
+    Encodes a list of JSON-serializable sort key values as an opaque,
+    URL-safe cursor.
+    """
+    data = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def decode_values(cursor, count):
+    """
+    Reverses encode_values.
+    :return: The list of values, or None if the cursor is invalid or does
+             not hold count values.
+    """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii'))
+                                  .decode('utf-8'))
+    except (AttributeError, TypeError, ValueError):
+        return None
+    if not isinstance(values, list) or len(values) != count:
+        return None
+    return values
+
+
+def ordered_page(queryset, fields, cursor=None, limit=50):
+    """
+    Returns one page of a queryset in ascending order of fields, with the
+    primary key as the final tie-breaker.
+    Like keyset_page, the page starts strictly after the position in the
+    cursor, so it can be served from an index on the same columns.
+    :param fields: The names of the fields to order by, e.g.
+                   ('last_name', 'first_name'). Their values must be JSON
+                   serializable.
+    :return: A tuple of the items on the page and the cursor for the next
+             page, or None if this is the last page.
+    """
+    keys = list(fields) + ['pk']
+    queryset = queryset.order_by(*keys)
+    position = decode_values(cursor, len(keys)) if cursor else None
+    if position:
+        # (a, b, pk) > (x, y, z) expands to
+        # a > x OR (a = x AND b > y) OR (a = x AND b = y AND pk > z).
+        after = Q()
+        for i, key in enumerate(keys):
+            clause = Q(**{key + '__gt': position[i]})
+            for previous, value in zip(keys[:i], position[:i]):
+                clause &= Q(**{previous: value})
+            after |= clause
+        queryset = queryset.filter(after)
+    items = list(queryset[:limit + 1])
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        next_cursor = encode_values([getattr(last, key) for key in keys])
+    return items, next_cursor
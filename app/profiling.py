@@ -0,0 +1,188 @@
+import collections
+import json
+import logging
+import random
+import re
+import time
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections
+
+logger = logging.getLogger('health.profiling')
+
+# Prefix of the cache keys holding the per-endpoint totals shown on the
+# SQL profile page.
+PROFILE_CACHE_KEY = 'sql-profile'
+# Totals kept for every endpoint, as integers so they can be incremented
+# atomically. Database time is in microseconds.
+COUNTERS = ('requests', 'queries', 'db_us', 'duplicates')
+# Statements listed as the slowest of each request.
+SLOWEST_COUNT = 3
+# Longest statement text kept in logs and totals.
+SQL_PREVIEW_LENGTH = 300
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_SPACE = re.compile(r'\s+')
+
+
+def fingerprint(sql):
+    """
+    Reduces a statement to its shape by replacing literals with '?' and
+    lists of them with a single '(?)', so the same query run with
+    different parameters has the same fingerprint.
+    """
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql)
+    sql = _LIST.sub('(?)', sql)
+    return _SPACE.sub(' ', sql).strip()
+
+
+def summarize(queries):
+    """
+    Summarizes the queries run by a request.
+    :param queries: Entries of connection.queries, with 'sql' and 'time'.
+    :return: A dictionary of the query count, the total database time in
+             milliseconds, the fingerprints run more than once with how
+             often, and the fingerprints of the slowest statements, so no
+             parameter values end up in logs.
+    """
+    counts = collections.Counter(fingerprint(q['sql']) for q in queries)
+    slowest = sorted(queries, key=lambda q: float(q['time']), reverse=True)
+    return {
+        'queries': len(queries),
+        'db_ms': round(sum(float(q['time']) for q in queries) * 1000, 1),
+        'duplicates': [{'sql': sql[:SQL_PREVIEW_LENGTH], 'count': count}
+                       for sql, count in counts.most_common() if count > 1],
+        'slowest': [{'sql': fingerprint(q['sql'])[:SQL_PREVIEW_LENGTH],
+                     'ms': round(float(q['time']) * 1000, 1)}
+                    for q in slowest[:SLOWEST_COUNT]],
+    }
+
+
+def cache_key(endpoint, name):
+    return '%s:%s:%s' % (PROFILE_CACHE_KEY, endpoint, name)
+
+
+def endpoints():
+    """
+    :return: The view names of every named route, the only endpoints
+             whose totals are kept.
+    """
+    from . import urls
+    return ['health:%s' % pattern.name for pattern in urls.urlpatterns
+            if pattern.name]
+
+
+def record(endpoint, profile):
+    """
+    Adds a request's profile to the totals for its endpoint. Each total
+    is its own cache key, incremented atomically, so concurrent requests
+    do not overwrite each other. Totals are only kept with a shared cache
+    (the SHARED_CACHE setting): a per-process cache would show whichever
+    worker served the profile page.
+    """
+    if not getattr(settings, 'SHARED_CACHE', False):
+        return
+    values = {
+        'requests': 1,
+        'queries': profile['queries'],
+        'db_us': int(round(profile['db_ms'] * 1000)),
+        'duplicates': sum(d['count'] - 1 for d in profile['duplicates']),
+    }
+    for name, value in values.items():
+        key = cache_key(endpoint, name)
+        cache.add(key, 0, None)
+        if value:
+            cache.incr(key, value)
+    if profile['duplicates']:
+        cache.set(cache_key(endpoint, 'top_duplicate'),
+                  profile['duplicates'][0]['sql'], None)
+
+
+def worst_endpoints(limit=25):
+    """
+    :return: The profiled endpoints with the most database time per
+             request first, each with its averages added.
+    """
+    names = endpoints()
+    keys = [cache_key(endpoint, name) for endpoint in names
+            for name in COUNTERS + ('top_duplicate',)]
+    totals = cache.get_many(keys)
+    rows = []
+    for endpoint in names:
+        row = {name: totals.get(cache_key(endpoint, name), 0)
+               for name in COUNTERS}
+        if not row['requests']:
+            continue
+        row['endpoint'] = endpoint
+        row['top_duplicate'] = totals.get(cache_key(endpoint, 'top_duplicate'))
+        row['avg_queries'] = row['queries'] / float(row['requests'])
+        row['avg_db_ms'] = row['db_us'] / 1000.0 / row['requests']
+        rows.append(row)
+    rows.sort(key=lambda row: row['avg_db_ms'], reverse=True)
+    return rows[:limit]
+
+
+class SQLProfileMiddleware(object):
+    """
+    Profiles the SQL of a sample of requests: the SQL_PROFILE_SAMPLE_RATE
+    setting is the fraction profiled, from 0 (off) to 1 (every request).
+    Unsampled requests pay for one random number.
+
+    The profile is logged as one JSON line to the 'health.profiling'
+    logger and added to the endpoint's totals for the SQL profile page.
+    Responses to staff also get a Server-Timing header with the query
+    count and database time; other users are not shown how the site
+    queries its database. Queries on every configured database are
+    counted, so reads sent to the replica are profiled along with the
+    primary's. Queries run while a streaming response is
+    consumed happen after the response leaves the middleware and are
+    not counted.
+    """
+
+    def process_request(self, request):
+        rate = getattr(settings, 'SQL_PROFILE_SAMPLE_RATE', 0)
+        if rate <= 0 or random.random() >= rate:
+            return None
+        # Each database's debug flag and how many queries it had logged.
+        databases = {}
+        for connection in connections.all():
+            databases[connection.alias] = (connection.force_debug_cursor,
+                                           len(connection.queries_log))
+            # Log queries even when DEBUG is off.
+            connection.force_debug_cursor = True
+        request.sql_profile_state = (databases, time.time())
+        return None
+
+    def process_response(self, request, response):
+        state = getattr(request, 'sql_profile_state', None)
+        if state is None:
+            return response
+        databases, started = state
+        queries = []
+        for connection in connections.all():
+            force_debug_cursor, start = databases.get(connection.alias,
+                                                      (False, 0))
+            connection.force_debug_cursor = force_debug_cursor
+            queries.extend(list(connection.queries_log)[start:])
+        profile = summarize(queries)
+        elapsed_ms = (time.time() - started) * 1000
+        match = getattr(request, 'resolver_match', None)
+        endpoint = match.view_name if match else request.path
+        logger.info(json.dumps(dict(profile, endpoint=endpoint,
+                                    method=request.method,
+                                    status=response.status_code,
+                                    total_ms=round(elapsed_ms, 1))))
+        if match:
+            record(endpoint, profile)
+        # The user is loaded only now, after the request's queries were
+        # counted.
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_staff:
+            response['Server-Timing'] = (
+                'db;dur=%.1f;desc="%d queries, %d duplicated", '
+                'total;dur=%.1f' % (profile['db_ms'], profile['queries'],
+                                    len(profile['duplicates']), elapsed_ms))
+        return response
@@ -0,0 +1,93 @@
+import threading
+import time
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# Alias of the read replica in DATABASES. Without one, everything uses
+# the primary and the router has no effect.
+REPLICA_DB_ALIAS = 'replica'
+# Session key holding the time until which the user reads from the
+# primary.
+PIN_SESSION_KEY = 'primary_until'
+
+_state = threading.local()
+
+
+def replica_configured():
+    return REPLICA_DB_ALIAS in settings.DATABASES
+
+
+def pin_to_primary(pinned=True):
+    """
+    Sends this thread's reads to the primary (or back to the replica).
+    """
+    _state.pinned = pinned
+
+
+def wrote_to_primary():
+    """
+    :return: Whether this thread has written to the primary since the
+             last reset().
+    """
+    return getattr(_state, 'wrote', False)
+
+
+def reset():
+    _state.pinned = False
+    _state.wrote = False
+
+
+class ReplicaRouter(object):
+    """
+    Sends reads to the replica and writes to the primary.
+    Reads go to the primary instead when the thread is pinned to it (see
+    ReplicaPinningMiddleware), once the thread has written something,
+    inside a transaction on the primary, and for sessions, which are
+    written on most requests.
+    """
+
+    def db_for_read(self, model, **hints):
+        if not replica_configured():
+            return None
+        if (getattr(_state, 'pinned', False) or wrote_to_primary() or
+                model._meta.app_label == 'sessions' or
+                connections[DEFAULT_DB_ALIAS].in_atomic_block):
+            return DEFAULT_DB_ALIAS
+        return REPLICA_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label != 'sessions':
+            _state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replica holds the same data, so objects from either database
+        # may be related.
+        return True
+
+
+class ReplicaPinningMiddleware(object):
+    """
+    Reads a user's own writes: requests that may write (anything but GET,
+    HEAD and OPTIONS) read from the primary, and after a request writes,
+    the user's session reads from the primary for REPLICA_PIN_SECONDS so
+    the redirect and pages after it do not see the replica lagging
+    behind. Must come after SessionMiddleware.
+    """
+
+    def process_request(self, request):
+        reset()
+        if not replica_configured():
+            return None
+        pin_to_primary(
+            request.method not in ('GET', 'HEAD', 'OPTIONS') or
+            request.session.get(PIN_SESSION_KEY, 0) > time.time())
+        return None
+
+    def process_response(self, request, response):
+        if replica_configured() and wrote_to_primary() and \
+                hasattr(request, 'session'):
+            request.session[PIN_SESSION_KEY] = (
+                time.time() + getattr(settings, 'REPLICA_PIN_SECONDS', 10))
+        reset()
+        return response
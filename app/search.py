@@ -0,0 +1,211 @@
+import re
+from django.db import DatabaseError, connection
+from .models import *
+from .pagination import decode_values, encode_values
+
+# Number of results per page of search results.
+SEARCH_PAGE_SIZE = 25
+
+# Name of the SQLite FTS5 table mirroring PatientSearchDocument.
+FTS_TABLE = 'patient_search_fts'
+
+
+def document_text(user):
+    """
+    Flattens everything a patient can be searched by into one string.
+    """
+    parts = [user.first_name, user.last_name, user.email, user.phone_number]
+    info = user.medical_information
+    if info:
+        parts += [info.medical_conditions, info.medications, info.allergies]
+    return ' '.join(part for part in parts if part)
+
+
+def index_user(user):
+    """
+    Writes the user's search document. Any search index built by
+    build_index is kept in step by the database itself (a GIN index on
+    PostgreSQL, triggers on SQLite).
+    """
+    PatientSearchDocument.objects.update_or_create(
+        user=user, defaults={'document': document_text(user)})
+
+
+def index_users(users, batch_size=1000):
+    """
+    Rebuilds the search documents for many users, replacing any existing
+    ones with bulk inserts.
+    :param users: A queryset of users.
+    :return: The number of users indexed.
+    """
+    count = 0
+    users = users.select_related('medical_information').order_by('pk')
+    last_pk = 0
+    while True:
+        batch = list(users.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            return count
+        PatientSearchDocument.objects.filter(user__in=batch).delete()
+        PatientSearchDocument.objects.bulk_create([
+            PatientSearchDocument(user=user, document=document_text(user))
+            for user in batch])
+        count += len(batch)
+        last_pk = batch[-1].pk
+
+
+def build_index():
+    """
+    Creates the database-specific search index over the search documents:
+    trigram and full-text GIN indexes on PostgreSQL, or an FTS5 table kept
+    in sync by triggers on SQLite. Safe to run more than once.
+    :return: The name of the backend the index was built for, or None if
+             the database has no supported full-text search.
+    """
+    table = PatientSearchDocument._meta.db_table
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            cursor.execute(
+                'CREATE INDEX IF NOT EXISTS {0}_trgm ON {0} '
+                'USING gin (document gin_trgm_ops)'.format(table))
+            cursor.execute(
+                "CREATE INDEX IF NOT EXISTS {0}_fts ON {0} "
+                "USING gin (to_tsvector('simple', document))".format(table))
+            return 'postgresql'
+        if connection.vendor == 'sqlite':
+            try:
+                cursor.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS {0} USING fts5("
+                    "document, content='{1}', content_rowid='user_id')"
+                    .format(FTS_TABLE, table))
+            except DatabaseError:
+                # This SQLite build was compiled without FTS5.
+                return None
+            cursor.execute(
+                "CREATE TRIGGER IF NOT EXISTS {0}_ai AFTER INSERT ON {1} BEGIN "
+                "INSERT INTO {0}(rowid, document) "
+                "VALUES (new.user_id, new.document); END".format(FTS_TABLE, table))
+            cursor.execute(
+                "CREATE TRIGGER IF NOT EXISTS {0}_ad AFTER DELETE ON {1} BEGIN "
+                "INSERT INTO {0}({0}, rowid, document) "
+                "VALUES ('delete', old.user_id, old.document); END"
+                .format(FTS_TABLE, table))
+            cursor.execute(
+                "CREATE TRIGGER IF NOT EXISTS {0}_au AFTER UPDATE ON {1} BEGIN "
+                "INSERT INTO {0}({0}, rowid, document) "
+                "VALUES ('delete', old.user_id, old.document); "
+                "INSERT INTO {0}(rowid, document) "
+                "VALUES (new.user_id, new.document); END"
+                .format(FTS_TABLE, table))
+            cursor.execute("INSERT INTO {0}({0}) VALUES ('rebuild')"
+                           .format(FTS_TABLE))
+            return 'sqlite'
+    return None
+
+
+def has_fts_table():
+    return FTS_TABLE in connection.introspection.table_names()
+
+
+def fts_query(query):
+    """
+    Turns free text into an FTS5 query matching every word as a prefix,
+    quoting each word so user input cannot inject query syntax.
+    """
+    words = re.findall(r'\w+', query, re.UNICODE)
+    return ' '.join('"%s"*' % word for word in words)
+
+
+def search(query, scope=None, cursor=None, page_size=SEARCH_PAGE_SIZE):
+    """
+    Finds users matching free text across their names, email, phone and
+    medical information, best matches first.
+    Uses the PostgreSQL full-text and trigram indexes or the SQLite FTS5
+    table when they exist, and falls back to a substring scan otherwise.
+    Results are ordered by (score, user id), lowest score first, and pages
+    start after the position in the cursor rather than at an OFFSET.
+    :param scope: A queryset of users to restrict the results to, e.g.
+                  user.all_patients(). It is applied inside the search
+                  query, so pages are always full.
+    :param cursor: The cursor returned for the previous page, if any.
+    :return: A tuple of the users on the page, in rank order, and the
+             cursor for the next page (None on the last page).
+    """
+    query = query.strip()
+    if not query:
+        return [], None
+    table = PatientSearchDocument._meta.db_table
+    position = decode_values(cursor, 2) if cursor else None
+    if position and not (isinstance(position[0], (int, float)) and
+                         isinstance(position[1], int)):
+        position = None
+    scope_sql, scope_params = '', []
+    if scope is not None:
+        scope_sql, scope_params = scope.values('pk').query.sql_with_params()
+        scope_params = list(scope_params)
+
+    def in_scope(column):
+        return ' AND %s IN (%s)' % (column, scope_sql) if scope_sql else ''
+
+    after_sql, after_params = '', []
+    if position:
+        after_sql = 'WHERE score > %s OR (score = %s AND user_id > %s) '
+        after_params = [position[0], position[0], position[1]]
+
+    if connection.vendor == 'postgresql':
+        # word_similarity and <% compare the query with the closest run of
+        # words in the document rather than with the whole document, so a
+        # misspelt name still matches a long document. The score is
+        # rounded so it survives the round trip through the cursor.
+        sql = ("SELECT user_id, score FROM ("
+               "SELECT user_id, -ROUND((ts_rank(to_tsvector('simple', "
+               "document), plainto_tsquery('simple', %s)) + "
+               "word_similarity(%s, document))::numeric, 6)::float8 AS score "
+               "FROM {0} WHERE (to_tsvector('simple', document) @@ "
+               "plainto_tsquery('simple', %s) OR %s <%% document){1}"
+               ") ranked {2}ORDER BY score, user_id LIMIT %s"
+               ).format(table, in_scope('user_id'), after_sql)
+        params = [query, query, query, query] + scope_params + \
+            after_params + [page_size + 1]
+    elif connection.vendor == 'sqlite' and has_fts_table():
+        match = fts_query(query)
+        if not match:
+            return [], None
+        # LIMIT -1 keeps SQLite from flattening the subquery, which would
+        # move bm25() into the outer WHERE, where FTS5 cannot run it.
+        sql = ("SELECT user_id, score FROM ("
+               "SELECT rowid AS user_id, bm25({0}) AS score FROM {0} "
+               "WHERE {0} MATCH %s{1} LIMIT -1"
+               ") ranked {2}ORDER BY score, user_id LIMIT %s"
+               ).format(FTS_TABLE, in_scope('rowid'), after_sql)
+        params = [match] + scope_params + after_params + [page_size + 1]
+    else:
+        documents = PatientSearchDocument.objects.filter(
+            document__icontains=query)
+        if scope is not None:
+            documents = documents.filter(user__in=scope.values('pk'))
+        if position:
+            documents = documents.filter(user__gt=position[1])
+        ids = list(documents.order_by('user')
+                            .values_list('user', flat=True)[:page_size + 1])
+        return ranked_users([(pk, 0) for pk in ids], page_size)
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall()
+    return ranked_users(rows, page_size)
+
+
+def ranked_users(rows, page_size):
+    """
+    Loads the users for a list of ranked (id, score) rows, keeping the
+    rank order.
+    :return: A tuple of the users and the cursor for the next page.
+    """
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        next_cursor = encode_values([rows[-1][1], rows[-1][0]])
+    ids = [pk for pk, _ in rows]
+    users = User.objects.select_related('medical_information').in_bulk(ids)
+    return [users[pk] for pk in ids if pk in users], next_cursor
@@ -0,0 +1,21 @@
+from django.dispatch import Signal
+
+# Domain events sent by the views. Every signal is sent with the model
+# class as sender and the acting user as 'user'; activitylog.py records
+# them.
+
+prescription_added = Signal(providing_args=['user', 'prescription'])
+prescription_edited = Signal(providing_args=['user', 'prescription', 'fields'])
+prescription_deleted = Signal(providing_args=['user', 'prescription'])
+
+appointment_added = Signal(providing_args=['user', 'appointment'])
+appointment_edited = Signal(providing_args=['user', 'appointment', 'fields'])
+appointment_deleted = Signal(providing_args=['user', 'appointment'])
+
+# 'patients' is a list of user ids, or None for every patient the user
+# can see; 'format' is 'json' or 'ndjson'.
+patients_exported = Signal(providing_args=['user', 'patients', 'format'])
+
+patient_admitted = Signal(providing_args=['user', 'patient', 'hospital'])
+# 'patients' is a list of user ids.
+patients_discharged = Signal(providing_args=['user', 'patients', 'hospital'])
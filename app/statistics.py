@@ -0,0 +1,118 @@
+import time
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import Avg, Case, Count, FloatField, IntegerField, Sum, When
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+from .models import *
+
+# How long, in seconds, computed statistics are served from the cache.
+STATISTICS_TTL = 60
+
+# Length of a hospital stay in seconds, per database vendor, so the
+# average can be computed by the database instead of in Python.
+STAY_SECONDS_SQL = {
+    'postgresql': 'EXTRACT(EPOCH FROM ("discharge" - "admission"))',
+    'sqlite': '(julianday("discharge") - julianday("admission")) * 86400.0',
+    'mysql': 'TIMESTAMPDIFF(SECOND, `admission`, `discharge`)',
+}
+
+
+def count_if(**conditions):
+    """
+    An aggregate that counts the rows matching the given lookups, so
+    several counts over one table can be computed in a single query.
+    """
+    return Sum(Case(When(then=1, **conditions), default=0,
+                    output_field=IntegerField()))
+
+
+def average_stay_seconds():
+    """
+    :return: The average length, in seconds, of every finished hospital
+             stay, or 0.0 if there are none.
+    """
+    stays = HospitalStay.objects.filter(discharge__isnull=False)
+    sql = STAY_SECONDS_SQL.get(connection.vendor)
+    if sql is None:
+        # Unknown backend; fall back to summing in Python.
+        durations = [(d - a).total_seconds()
+                     for a, d in stays.values_list('admission', 'discharge')]
+        return sum(durations) / len(durations) if durations else 0.0
+    average = stays.aggregate(
+        average=Avg(RawSQL(sql, (), output_field=FloatField())))['average']
+    # Date arithmetic in some backends (e.g. SQLite's julianday) is done
+    # in floating point, so drop sub-millisecond noise.
+    return round(float(average or 0.0), 3)
+
+
+def compute_statistics(hospital):
+    """
+    Computes every metric shown on the logs page using one aggregate
+    query per table.
+    :param hospital: The hospital whose stays are counted.
+    :return: A dictionary of statistics, keyed as logs.html expects.
+    """
+    now = timezone.now()
+    stays = HospitalStay.objects.filter(hospital=hospital).aggregate(
+        stay_count=Count('pk'),
+        discharge_count=count_if(discharge__isnull=False),
+        user_count=count_if(discharge__isnull=True),
+    )
+    roles = dict(HospitalStay.objects
+                 .filter(hospital=hospital,
+                         patient__groups__name__in=['Patient', 'Doctor', 'Nurse'])
+                 .values('patient__groups__name')
+                 .annotate(count=Count('pk', distinct=True))
+                 .values_list('patient__groups__name', 'count'))
+    prescriptions = Prescription.objects.aggregate(
+        prescription_count=Count('pk'),
+        active_prescription_count=count_if(active=True),
+    )
+    appointments = Appointment.objects.aggregate(
+        appointment_count=Count('pk'),
+        upcoming_appointment_count=count_if(date__gte=now),
+    )
+    group_count = MessageGroup.objects.count()
+    message_count = Message.objects.count()
+    average_count = 0
+    if group_count > 0 and message_count > 0:
+        average_count = float(message_count) / float(group_count)
+
+    prescription_count = prescriptions['prescription_count']
+    active_count = prescriptions['active_prescription_count'] or 0
+    appointment_count = appointments['appointment_count']
+    upcoming_count = appointments['upcoming_appointment_count'] or 0
+    return {
+        "user_count": stays['user_count'] or 0,
+        "stay_count": stays['stay_count'],
+        "discharge_count": stays['discharge_count'] or 0,
+        "average_stay": time.strftime('%H:%M:%S',
+                                      time.gmtime(average_stay_seconds())),
+        "patient_count": roles.get('Patient', 0),
+        "doctor_count": roles.get('Doctor', 0),
+        "nurse_count": roles.get('Nurse', 0),
+        "admin_count": User.objects.filter(is_superuser=True).count(),
+        "prescription_count": prescription_count,
+        "active_prescription_count": active_count,
+        "expired_prescription_count": prescription_count - active_count,
+        "appointment_count": appointment_count,
+        "upcoming_appointment_count": upcoming_count,
+        "past_appointment_count": appointment_count - upcoming_count,
+        "conversation_count": group_count,
+        "average_message_count": average_count,
+        "message_count": message_count
+    }
+
+
+def hospital_statistics(hospital):
+    """
+    Returns the statistics for a hospital, recomputing them at most once
+    every STATISTICS_TTL seconds.
+    """
+    key = 'statistics:%s' % (hospital.pk if hospital else 'none')
+    stats = cache.get(key)
+    if stats is None:
+        stats = compute_statistics(hospital)
+        cache.set(key, stats, STATISTICS_TTL)
+    return stats
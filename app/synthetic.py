@@ -0,0 +1,232 @@
+import datetime
+import random
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import Group
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+from . import search
+from .models import *
+
+# Password of every generated user.
+PASSWORD = 'p@ssword'
+
+FIRST_NAMES = ('Ada', 'Ben', 'Cleo', 'Dev', 'Elif', 'Femi', 'Gus', 'Hana',
+               'Ivan', 'Jia', 'Kofi', 'Lena', 'Milo', 'Nia', 'Omar', 'Pia',
+               'Quinn', 'Rosa', 'Sami', 'Tara', 'Uma', 'Vik', 'Wen', 'Yara')
+LAST_NAMES = ('Abbott', 'Baker', 'Chen', 'Diaz', 'Evans', 'Fischer', 'Garcia',
+              'Haddad', 'Ito', 'Jones', 'Kowalski', 'Lopez', 'Moreau',
+              'Nguyen', 'Okafor', 'Patel', 'Quist', 'Rossi', 'Singh',
+              'Tanaka', 'Usman', 'Vega', 'Walsh', 'Young')
+CONDITIONS = ('Asthma', 'Diabetes', 'Hypertension', 'Migraine', 'Anemia',
+              'Arthritis', 'Eczema', 'Insomnia')
+DRUGS = ('Albuterol', 'Metformin', 'Lisinopril', 'Sumatriptan', 'Ibuprofen',
+         'Amoxicillin', 'Cetirizine', 'Melatonin')
+# Rows per INSERT statement, where the database allows that many.
+INSERT_BATCH_SIZE = 1000
+# Users created per transaction by Generator.generate.
+CHUNK_SIZE = 5000
+
+
+def bulk_create(model, objects):
+    """
+    Inserts objects INSERT_BATCH_SIZE at a time, or fewer where the
+    database limits the size of a statement: given a batch size, Django's
+    bulk_create does not apply SQLite's limits itself.
+    """
+    fields = [f for f in model._meta.concrete_fields if not f.auto_created]
+    batch_size = min(INSERT_BATCH_SIZE,
+                     connection.ops.bulk_batch_size(fields, objects))
+    model.objects.bulk_create(objects, batch_size=max(batch_size, 1))
+
+
+def bulk_insert(model, objects):
+    """
+    Inserts objects with bulk inserts and reads their primary keys back
+    in insertion order, since bulk_create does not set them on every
+    backend. Nothing else may write to the table meanwhile.
+    :return: The list of new primary keys.
+    """
+    last = model.objects.aggregate(last=Max('pk'))['last'] or 0
+    bulk_create(model, objects)
+    return list(model.objects.filter(pk__gt=last).order_by('pk')
+                             .values_list('pk', flat=True))
+
+
+class Generator(object):
+    """
+    Builds a synthetic dataset of hospitals, staff, patients and their
+    appointments, prescriptions and conversations with bulk inserts.
+    The same seed always produces the same dataset.
+    """
+
+    def __init__(self, seed=0):
+        self.random = random.Random(seed)
+        self.password = make_password(PASSWORD)
+        self.now = timezone.now().replace(minute=0, second=0, microsecond=0)
+        self.groups = {name: Group.objects.get_or_create(name=name)[0]
+                       for name in ROSTER_GROUPS}
+
+    def name(self):
+        return (self.random.choice(FIRST_NAMES),
+                self.random.choice(LAST_NAMES))
+
+    def hospitals(self, count):
+        return bulk_insert(Hospital, [
+            Hospital(name='General Hospital %d' % i,
+                     address='%d Main Street' % (i + 1), city='Rochester',
+                     state='New York', zipcode='146%02d' % (i % 100))
+            for i in range(count)])
+
+    def users(self, role, count, hospitals, medical_information=None,
+              offset=0):
+        """
+        Creates users in a role, admitted round-robin to the hospitals.
+        :param offset: The number of users of the role created before, so
+                       email addresses stay unique across chunks.
+        :param medical_information: Primary keys of the users' medical
+                                    information, one per user.
+        :return: The new users' primary keys.
+        """
+        users = []
+        for i in range(count):
+            first, last = self.name()
+            number = offset + i
+            email = '%s%d@example.com' % (role.lower(), number)
+            users.append(User(
+                username=email, email=email, password=self.password,
+                first_name=first, last_name=last,
+                phone_number='555%07d' % number,
+                date_of_birth=datetime.date(1940 + number % 60,
+                                            1 + number % 12, 1 + number % 28),
+                medical_information_id=(medical_information[i]
+                                        if medical_information else None)))
+        pks = bulk_insert(User, users)
+        bulk_create(User.groups.through, [
+            User.groups.through(user_id=pk, group_id=self.groups[role].pk)
+            for pk in pks])
+        for i, hospital in enumerate(hospitals):
+            Hospital(pk=hospital).admit_many(pks[i::len(hospitals)])
+        return pks
+
+    def medical_information(self, count):
+        insurance = bulk_insert(Insurance, [
+            Insurance(policy_number='%08d' % i, company='Acme Health')
+            for i in range(count)])
+        return bulk_insert(MedicalInformation, [
+            MedicalInformation(
+                sex=self.random.choice(MedicalInformation.SEX_CHOICES),
+                insurance_id=pk,
+                medical_conditions=self.random.choice(CONDITIONS),
+                allergies=None, medications=None, family_history=None,
+                additional_info=None)
+            for pk in insurance])
+
+    def appointments(self, doctors, patients, per_patient):
+        """
+        Books per_patient half-hour appointments for every patient, half
+        in the past and half in the future, with a random doctor.
+        """
+        appointments = []
+        for patient in patients:
+            for i in range(per_patient):
+                date = self.now + datetime.timedelta(
+                    hours=self.random.randint(-24 * 60, 24 * 60))
+                appointments.append(Appointment(
+                    doctor_id=self.random.choice(doctors), patient_id=patient,
+                    date=date, duration=30,
+                    # bulk_create skips save(), which sets end_date.
+                    end_date=date + datetime.timedelta(minutes=30)))
+        bulk_create(Appointment, appointments)
+
+    def prescriptions(self, patients, per_patient):
+        bulk_create(Prescription, [
+            Prescription(patient_id=patient, name=self.random.choice(DRUGS),
+                         dosage='%d mg' % self.random.choice((5, 10, 50, 100)),
+                         directions='Take daily.', active=i == 0,
+                         prescribed=self.now - datetime.timedelta(days=30 * i))
+            for patient in patients for i in range(per_patient)])
+
+    def conversations(self, doctors, patients, per_group):
+        """
+        Starts one conversation between every patient and a random doctor,
+        with per_group messages alternating between them. Every message
+        is read except the doctor's last one, which the patient has not
+        seen yet.
+        """
+        if not per_group or not patients:
+            return
+        pairs = [(patient, self.random.choice(doctors)) for patient in patients]
+        groups = bulk_insert(MessageGroup, [
+            MessageGroup(name='Conversation') for _ in pairs])
+        bulk_create(MessageGroup.members.through, [
+            MessageGroup.members.through(messagegroup_id=group, user_id=user)
+            for group, pair in zip(groups, pairs) for user in pair])
+        messages, readers = [], []
+        for group, (patient, doctor) in zip(groups, pairs):
+            for i in range(per_group):
+                sender = doctor if (per_group - i) % 2 else patient
+                messages.append(Message(
+                    group_id=group, sender_id=sender,
+                    body='Message %d about the appointment.' % i,
+                    date=self.now - datetime.timedelta(minutes=per_group - i)))
+                last = i == per_group - 1
+                readers.append((doctor,) if last else (doctor, patient))
+        pks = bulk_insert(Message, messages)
+        bulk_create(Message.read_members.through, [
+            Message.read_members.through(message_id=pk, user_id=user)
+            for pk, users in zip(pks, readers) for user in users])
+        # bulk_insert returns consecutive keys, so a range covers them.
+        User.objects.filter(pk__range=(patients[0], patients[-1]))\
+                    .update(unread_messages=1)
+
+    def generate(self, hospitals=3, doctors=20, nurses=10, patients=1000,
+                 appointments_per_patient=2, prescriptions_per_patient=2,
+                 messages_per_group=10, chunk_size=CHUNK_SIZE, progress=None):
+        """
+        Builds the whole dataset. Users are created chunk_size at a time,
+        and each chunk of patients is inserted together with everything
+        that belongs to them in its own transaction, so memory use stays
+        flat however large the dataset is.
+        :param progress: Called as progress(role, done, total) after each
+                         chunk.
+        :return: A dictionary mapping 'hospitals', 'doctors', 'nurses' and
+                 'patients' to the new primary keys.
+        """
+        with transaction.atomic():
+            hospital_pks = self.hospitals(hospitals)
+        created = {'hospitals': hospital_pks}
+        for role, total in (('Doctor', doctors), ('Nurse', nurses),
+                            ('Patient', patients)):
+            pks = created[role.lower() + 's'] = []
+            for offset in range(0, total, chunk_size):
+                count = min(chunk_size, total - offset)
+                with transaction.atomic():
+                    if role != 'Patient':
+                        pks += self.users(role, count, hospital_pks,
+                                          offset=offset)
+                    else:
+                        pks += self.patients(
+                            count, hospital_pks, created['doctors'], offset,
+                            appointments_per_patient,
+                            prescriptions_per_patient, messages_per_group)
+                if progress:
+                    progress(role, len(pks), total)
+        return created
+
+    def patients(self, count, hospitals, doctors, offset, appointments,
+                 prescriptions, messages):
+        """
+        Creates count patients with their medical information, search
+        documents, appointments, prescriptions and a conversation.
+        :return: The new patients' primary keys.
+        """
+        pks = self.users('Patient', count, hospitals,
+                         self.medical_information(count), offset=offset)
+        if doctors:
+            self.appointments(doctors, pks, appointments)
+            self.conversations(doctors, pks, messages)
+        self.prescriptions(pks, prescriptions)
+        search.index_users(User.objects.filter(pk__range=(pks[0], pks[-1])),
+                           batch_size=INSERT_BATCH_SIZE)
+        return pks
@@ -1,8 +1,43 @@
-from django.test import TestCase
+from django.contrib.admin.models import ADDITION, CHANGE, LogEntry
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.http import HttpResponse
+from django.test import (RequestFactory, TestCase, TransactionTestCase,
+                         skipUnlessDBFeature)
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils.http import http_date
+from unittest import mock, skipUnless
 import datetime
+import gzip
+import io
+import json
+import os
+import pytz
+import re
+import shutil
+import tempfile
+import threading
 from .models import *
+from .exports import export_queryset, stream_ndjson
+from .management.commands import export_patients
+from . import activitylog
+from . import auditlog
+from . import availability
+from . import ical
+from . import profiling
+from . import routers
+from . import search
+from . import signals
+from . import synthetic
+from .statistics import compute_statistics
+from .views import book_appointment, handle_user_form
 
 
+# Background audit writes would run outside the test's transaction.
+@override_settings(AUDIT_LOG_ASYNC=False)
 class UserTestCase(TestCase):
 
     def setUp(self):
@@ -90,4 +125,992 @@ class UserTestCase(TestCase):
     def test_can_add_prescription(self):
         self.assertTrue(self.doctor.can_add_prescription())
         self.assertFalse(self.patient.can_add_prescription())
-        self.assertFalse(self.nurse.can_add_prescription())
\ No newline at end of file
+        self.assertFalse(self.nurse.can_add_prescription())
+
+    def test_nurse_edits_only_users_in_same_hospital(self):
+        self.assertTrue(self.nurse.can_edit_user(self.patient))
+        hospital = self.nurse.hospital()
+        for user in (self.nurse, self.doctor):
+            hospital.discharge(user)
+        nurse = User.objects.get(pk=self.nurse.pk)
+        doctor = User.objects.get(pk=self.doctor.pk)
+        admin = User.objects.get(username='admin')
+        hospital.discharge(admin)
+        # Neither being admitted anywhere is not the same hospital.
+        self.assertFalse(nurse.can_edit_user(doctor))
+        self.assertFalse(nurse.can_edit_user(User.objects.get(pk=admin.pk)))
+        self.assertFalse(nurse.can_edit_user(self.patient))
+
+    def test_role_checks_use_one_query(self):
+        user = User.objects.get(pk=self.doctor.pk)
+        with self.assertNumQueries(1):
+            self.assertTrue(user.is_doctor())
+            self.assertFalse(user.is_patient())
+            self.assertFalse(user.is_nurse())
+            self.assertTrue(user.can_add_prescription())
+
+    def test_views_resolve_roles_with_one_query(self):
+        # The query group_names() runs; rosters also join auth_group but
+        # select from the membership table.
+        role_query = re.compile(r'SELECT \W?auth_group\W?\.\W?name\W? '
+                                r'FROM \W?auth_group\W? ', re.IGNORECASE)
+        views = ('home', 'prescriptions', 'add_prescription', 'schedule',
+                 'add_appointment', 'messages', 'users', 'search',
+                 'my_medical_information')
+        for user in (self.doctor, self.nurse, self.patient):
+            self.client.login(username=user.username, password="p@ssword")
+            for view in views:
+                with CaptureQueriesContext(connection) as queries:
+                    self.client.get(reverse('health:' + view))
+                role_queries = [q for q in queries
+                                if role_query.match(q['sql'])]
+                self.assertLessEqual(len(role_queries), 1, '%s as %s' % (
+                    view, user.group().name))
+
+    def test_role_cache_invalidated_on_group_change(self):
+        self.assertFalse(self.nurse.is_doctor())
+        self.nurse.groups.add(Group.objects.get(name="Doctor"))
+        self.assertTrue(self.nurse.is_doctor())
+
+    def test_role_cache_invalidated_on_reverse_group_change(self):
+        doctors = Group.objects.get(name="Doctor")
+        self.assertFalse(self.nurse.is_doctor())
+        doctors.user_set.add(self.nurse)
+        self.assertTrue(self.nurse.is_doctor())
+        doctors.user_set.remove(self.nurse)
+        self.assertFalse(self.nurse.is_doctor())
+        self.assertTrue(self.doctor.is_doctor())
+        doctors.user_set.clear()
+        self.assertFalse(self.doctor.is_doctor())
+
+    def test_is_free(self):
+        start = timezone.now().replace(microsecond=0) + timedelta(days=1)
+        Appointment.objects.create(doctor=self.doctor, patient=self.patient,
+                                   date=start, duration=30)
+        self.assertFalse(self.doctor.is_free(start + timedelta(minutes=15), 30))
+        self.assertFalse(self.doctor.is_free(start - timedelta(minutes=15), 30))
+        self.assertTrue(self.doctor.is_free(start + timedelta(minutes=45), 30))
+        self.assertTrue(self.nurse.is_free(start, 30))
+
+    def test_free_slots(self):
+        start = timezone.now().replace(microsecond=0) + timedelta(days=1)
+        Appointment.objects.create(doctor=self.doctor, patient=self.patient,
+                                   date=start + timedelta(minutes=60),
+                                   duration=30)
+        self.doctor.is_doctor()  # resolve the role before counting
+        with self.assertNumQueries(1):
+            slots = self.doctor.free_slots(start, start + timedelta(hours=3), 30)
+        self.assertEqual(slots, [start + timedelta(minutes=m)
+                                 for m in (0, 120, 150)])
+
+    def test_failed_reschedule_keeps_appointment(self):
+        start = timezone.now().replace(microsecond=0) + timedelta(days=1)
+        first, _ = book_appointment(self.doctor, self.patient, start, 30)
+        second, _ = book_appointment(self.doctor, self.patient,
+                                     start + timedelta(hours=1), 30)
+        moved, message = book_appointment(self.doctor, self.patient,
+                                          start + timedelta(minutes=50), 30,
+                                          appointment=first)
+        self.assertIsNone(moved)
+        self.assertTrue(message)
+        self.assertEqual(Appointment.objects.get(pk=first.pk).date, start)
+
+        moved, message = book_appointment(self.doctor, self.patient,
+                                          start + timedelta(minutes=10), 30,
+                                          appointment=first)
+        self.assertIsNone(message)
+        self.assertEqual(Appointment.objects.count(), 2)
+
+    def test_schedule_query_count_is_constant(self):
+        now = timezone.now().replace(microsecond=0)
+
+        def book(first_day, count):
+            for day in range(first_day, first_day + count):
+                for sign in (1, -1):
+                    Appointment.objects.create(
+                        doctor=self.doctor, patient=self.patient, duration=30,
+                        date=now + sign * timedelta(days=day))
+
+        self.client.login(username=self.doctor.username, password="p@ssword")
+        book(1, 1)
+        # The first request fills per-process caches such as ContentType's.
+        self.client.get(reverse('health:schedule'))
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('health:schedule'))
+        self.assertEqual(len(response.context['schedule_future']), 1)
+
+        book(2, 5)
+        with self.assertNumQueries(len(queries)):
+            response = self.client.get(reverse('health:schedule'))
+        self.assertEqual(len(response.context['schedule_future']), 6)
+        self.assertEqual(len(response.context['schedule_past']), 6)
+
+    def _start_conversation(self, name, sender, *members):
+        group = MessageGroup.objects.create(name=name)
+        group.members.add(sender, *members)
+        for i in range(3):
+            Message.objects.create(sender=sender, group=group,
+                                   body="Message %d" % i,
+                                   date=timezone.now() + timedelta(seconds=i))
+        return group
+
+    def test_inbox(self):
+        first = self._start_conversation("Results", self.doctor, self.patient)
+        second = self._start_conversation("Refill", self.nurse, self.patient)
+        for message in second.messages.all():
+            message.read_members.add(self.patient)
+
+        with self.assertNumQueries(4):
+            groups, cursor = self.patient.inbox()
+            names = [g.combined_names() for g in groups]
+        self.assertIsNone(cursor)
+        self.assertEqual([g.pk for g in groups], [second.pk, first.pk])
+        self.assertEqual(groups[0].last_message.body, "Message 2")
+        self.assertFalse(groups[0].has_unread)
+        self.assertEqual(groups[1].unread_count, 3)
+        self.assertEqual(len(names), 2)
+
+        for i in range(5):
+            self._start_conversation("Group %d" % i, self.doctor, self.patient)
+        with self.assertNumQueries(4):
+            groups, cursor = self.patient.inbox()
+            [g.combined_names() for g in groups]
+        self.assertEqual(len(groups), 7)
+
+        page, cursor = self.patient.inbox(limit=4)
+        older, last = self.patient.inbox(cursor=cursor, limit=4)
+        self.assertEqual([g.pk for g in page + older], [g.pk for g in groups])
+        self.assertIsNone(last)
+
+    def test_mark_read(self):
+        group = self._start_conversation("Results", self.doctor, self.patient)
+        messages = list(group.messages.order_by('pk'))
+        self.assertEqual(group.mark_read(self.patient, up_to=messages[1].pk), 2)
+        self.assertEqual(self.patient.read_messages.count(), 2)
+        self.assertEqual(group.mark_read(self.patient, up_to=messages[0].pk), 0)
+        self.assertEqual(group.mark_read(self.patient), 1)
+        self.assertEqual(group.mark_read(self.patient), 0)
+        self.assertFalse(self.patient.inbox()[0][0].has_unread)
+
+    def test_messages_page(self):
+        group = self._start_conversation("Results", self.doctor, self.patient)
+        page, cursor = group.messages_page(limit=2)
+        self.assertEqual([m.body for m in page], ["Message 2", "Message 1"])
+        page, cursor = group.messages_page(cursor=cursor, limit=2)
+        self.assertEqual([m.body for m in page], ["Message 0"])
+        self.assertIsNone(cursor)
+
+    def test_unread_counter(self):
+        group = MessageGroup.objects.create(name="Results")
+        group.members.add(self.doctor, self.patient)
+        group.post(self.doctor, "Your results are in.")
+        group.post(self.doctor, "Please call the office.")
+
+        patient = User.objects.get(pk=self.patient.pk)
+        doctor = User.objects.get(pk=self.doctor.pk)
+        self.assertEqual(patient.unread_message_count(), 2)
+        self.assertEqual(patient.count_unread_messages(), 2)
+        self.assertEqual(doctor.unread_message_count(), 0)
+
+        group.mark_read(patient)
+        patient = User.objects.get(pk=self.patient.pk)
+        self.assertEqual(patient.unread_message_count(), 0)
+
+    def test_conversation_only_for_members(self):
+        group = self._start_conversation("Results", self.doctor, self.patient)
+        own = self._start_conversation("Refill", self.doctor, self.nurse)
+        User.objects.filter(pk=self.nurse.pk).update(unread_messages=3)
+        self.client.login(username=self.nurse.username, password="p@ssword")
+
+        response = self.client.get(reverse('health:conversation', args=(group.pk,)))
+        self.assertEqual(response.status_code, 403)
+        response = self.client.post(reverse('health:conversation', args=(group.pk,)),
+                                    {'message': 'Hello'})
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(group.messages.count(), 3)
+        nurse = User.objects.get(pk=self.nurse.pk)
+        self.assertEqual(nurse.unread_message_count(), 3)
+        self.assertEqual(nurse.count_unread_messages(), 3)
+
+        response = self.client.get(reverse('health:conversation', args=(own.pk,)))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(User.objects.get(pk=self.nurse.pk).unread_message_count(), 0)
+
+    def _submit_user_form(self, user, **changes):
+        body = {
+            'first_name': user.first_name, 'last_name': user.last_name,
+            'email': user.email, 'phone_number': user.phone_number,
+            'month': user.date_of_birth.month, 'day': user.date_of_birth.day,
+            'year': user.date_of_birth.year, 'sex': 'Male',
+            'policy': '8675309', 'company': "Hobo Sal's Used Needle Emporium",
+        }
+        body.update(changes)
+        request = RequestFactory().post('/', body)
+        request.user = self.doctor
+        return handle_user_form(request, request.POST, user=user)
+
+    def test_user_form_keeps_unread_counter(self):
+        patient = User.objects.get(pk=self.patient.pk)
+        group = MessageGroup.objects.create(name="Results")
+        group.members.add(self.doctor, self.patient)
+        # Arrives after the form's copy of the patient was loaded.
+        group.post(self.doctor, "Your results are in.")
+
+        user, message = self._submit_user_form(patient, first_name="Dwayne")
+        self.assertIsNone(message)
+        patient = User.objects.get(pk=self.patient.pk)
+        self.assertEqual(patient.first_name, "Dwayne")
+        self.assertEqual(patient.unread_message_count(), 1)
+
+    def test_statistics(self):
+        hospital = self.patient.hospital()
+        now = timezone.now()
+        HospitalStay.objects.filter(patient=self.nurse).update(
+            admission=now - timedelta(hours=2), discharge=now)
+        Prescription.objects.create(patient=self.patient, name="Aspirin",
+                                    dosage="81mg", directions="Daily",
+                                    prescribed=timezone.now(), active=False)
+        with self.assertNumQueries(8):
+            stats = compute_statistics(hospital)
+        self.assertEqual(stats['stay_count'], 6)
+        self.assertEqual(stats['discharge_count'], 1)
+        self.assertEqual(stats['user_count'], 5)
+        self.assertEqual(stats['average_stay'], '02:00:00')
+        self.assertEqual(stats['doctor_count'], 4)
+        self.assertEqual(stats['nurse_count'], 1)
+        self.assertEqual(stats['patient_count'], 1)
+        self.assertEqual(stats['admin_count'], 1)
+        self.assertEqual(stats['expired_prescription_count'], 1)
+
+    def _export_patient(self):
+        user = export_queryset(User.objects).get(pk=self.patient.pk)
+        return user.json_object()
+
+    def test_export_query_count(self):
+        start = timezone.now() + timedelta(days=1)
+        Appointment.objects.create(doctor=self.doctor, patient=self.patient,
+                                   date=start, duration=30)
+        with self.assertNumQueries(5):
+            record = self._export_patient()
+        self.assertEqual(len(record['appointments']), 1)
+        self.assertEqual(record['hospital']['name'],
+                         "University of Rochester Medical Center")
+
+        for i in range(1, 5):
+            Appointment.objects.create(doctor=self.doctor, patient=self.patient,
+                                       date=start + timedelta(hours=i),
+                                       duration=30)
+            Prescription.objects.create(patient=self.patient, name="Drug %d" % i,
+                                        dosage="1", directions="Daily",
+                                        prescribed=timezone.now(), active=True)
+        with self.assertNumQueries(5):
+            record = self._export_patient()
+        self.assertEqual(len(record['appointments']), 5)
+        self.assertEqual(len(record['prescriptions']), 4)
+
+    def test_export_checks_permission_before_loading(self):
+        self.client.login(username=self.patient.username, password="p@ssword")
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('health:export',
+                                               args=(self.doctor.pk,)))
+        self.assertEqual(response.status_code, 403)
+        tables = (Appointment._meta.db_table, Prescription._meta.db_table)
+        self.assertEqual([q['sql'] for q in queries
+                          if any(table in q['sql'] for table in tables)], [])
+        response = self.client.get(reverse('health:export_me'))
+        self.assertEqual(response.status_code, 200)
+
+    def test_stream_ndjson(self):
+        lines = list(stream_ndjson(User.objects.all(), chunk_size=2))
+        self.assertEqual(len(lines), User.objects.count())
+        emails = [json.loads(line)['email'] for line in lines]
+        self.assertIn(self.patient.email, emails)
+
+    def test_current_hospital(self):
+        patient = User.objects.get(pk=self.patient.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(patient.hospital().name,
+                             "University of Rochester Medical Center")
+            patient.hospital()
+
+        highland = Hospital.objects.get(name="Highland Hospital")
+        highland.admit(patient)
+        self.assertEqual(patient.hospital(), highland)
+        self.assertEqual(User.objects.get(pk=patient.pk).hospital(), highland)
+
+        highland.discharge(patient)
+        self.assertIsNone(User.objects.get(pk=patient.pk).hospital())
+
+    def test_user_form_keeps_current_stay(self):
+        patient = User.objects.get(pk=self.patient.pk)
+        highland = Hospital.objects.get(name="Highland Hospital")
+        # Admitted after the form's copy of the patient was loaded.
+        highland.admit(User.objects.get(pk=self.patient.pk))
+
+        user, message = self._submit_user_form(patient, first_name="Dwayne")
+        self.assertIsNone(message)
+        self.assertEqual(User.objects.get(pk=self.patient.pk).hospital(),
+                         highland)
+
+    # The test run is one process, so its local cache is shared.
+    @override_settings(SHARED_CACHE=True)
+    def test_rosters(self):
+        hospital = self.patient.hospital()
+        Hospital.clear_roster_cache(hospital.pk)
+        with self.assertNumQueries(1):
+            rosters = hospital.rosters()
+        self.assertEqual([u.first_name for u in rosters['Doctor']],
+                         ["Administrator", "Christopher", "John", "Perry"])
+        self.assertEqual(rosters['Nurse'], [self.nurse])
+        self.assertEqual(rosters['Patient'], [self.patient])
+        with self.assertNumQueries(1):
+            self.assertEqual(hospital.rosters(), rosters)
+
+        # Users are cached by primary key, so edits show up at once.
+        User.objects.filter(pk=self.nurse.pk).update(first_name="Laverne")
+        self.assertEqual([u.first_name for u in hospital.users_in_group('Nurse')],
+                         ["Laverne"])
+
+        Group.objects.get(name="Patient").user_set.add(self.nurse)
+        self.assertEqual(len(hospital.users_in_group('Patient')), 2)
+
+    def test_rosters_not_cached_without_shared_cache(self):
+        hospital = self.patient.hospital()
+        hospital.rosters()
+        self.assertIsNone(cache.get(Hospital.roster_cache_key(hospital.pk)))
+
+    def test_admit_and_discharge_many(self):
+        highland = Hospital.objects.get(name="Highland Hospital")
+        users = [self.patient, self.nurse]
+        # Every chunk moves its own users' current stays.
+        with mock.patch(Hospital.__module__ + '.ADMIT_CHUNK_SIZE', 1):
+            self.assertEqual(highland.admit_many(users), 2)
+        for user in users:
+            user = User.objects.get(pk=user.pk)
+            self.assertEqual(user.hospital(), highland)
+            self.assertEqual(HospitalStay.objects.filter(
+                patient=user, discharge__isnull=True).count(), 1)
+
+        self.assertEqual(highland.discharge_many(users),
+                         sorted(user.pk for user in users))
+        self.assertEqual(highland.discharge_many(users), [])
+        for user in users:
+            self.assertIsNone(User.objects.get(pk=user.pk).hospital())
+        self.assertFalse(HospitalStay.objects.filter(
+            patient__in=users, discharge__isnull=True).exists())
+
+    def _move_patients(self, rows, **options):
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as f:
+            f.write('user,hospital,action\n')
+            f.writelines('%d,%d,%s\n' % row for row in rows)
+        self.addCleanup(os.remove, f.name)
+        call_command('move_patients', f.name, stdout=io.StringIO(), **options)
+
+    def test_move_patients_in_file_order(self):
+        highland = Hospital.objects.get(name="Highland Hospital")
+        rit = Hospital.objects.get(name="RIT Health Center")
+        self._move_patients([
+            (self.patient.pk, highland.pk, 'admit'),
+            (self.nurse.pk, highland.pk, 'admit'),
+            (self.patient.pk, rit.pk, 'transfer'),
+            (self.nurse.pk, highland.pk, 'discharge'),
+        ], batch_size=1)
+        self.assertEqual(User.objects.get(pk=self.patient.pk).hospital(), rit)
+        self.assertIsNone(User.objects.get(pk=self.nurse.pk).hospital())
+        self.assertEqual(HospitalStay.objects.filter(
+            patient=self.patient, discharge__isnull=True).count(), 1)
+
+    def test_move_patients_records_actual_moves(self):
+        highland = Hospital.objects.get(name="Highland Hospital")
+        self._move_patients([
+            (self.patient.pk, highland.pk, 'admit'),
+            (self.patient.pk, highland.pk, 'discharge'),
+            # The nurse is not at Highland, so nothing is discharged.
+            (self.nurse.pk, highland.pk, 'discharge'),
+        ])
+        events = ActivityEvent.objects.order_by('pk')
+        self.assertEqual([(e.action, e.object_id) for e in events],
+                         [('patient.admitted', self.patient.pk),
+                          ('patient.discharged', self.patient.pk)])
+        self.assertIsNotNone(User.objects.get(pk=self.nurse.pk).hospital())
+
+    def test_move_patients_rejects_unknown_users(self):
+        highland = Hospital.objects.get(name="Highland Hospital")
+        missing = User.objects.order_by('-pk')[0].pk + 1
+        with self.assertRaisesRegex(CommandError, 'Unknown user: %d' % missing):
+            self._move_patients([(self.patient.pk, highland.pk, 'admit'),
+                                 (missing, highland.pk, 'admit')])
+        # The file is rejected before anything is moved.
+        self.assertNotEqual(User.objects.get(pk=self.patient.pk).hospital(),
+                            highland)
+
+    def _add_patients(self, count):
+        patients = Group.objects.get(name="Patient")
+        users = []
+        for i in range(count):
+            email = "patient%d@example.com" % i
+            user = User.objects.create_user(email, email=email, first_name="Patient",
+                     last_name=str(i), password="p@ssword", phone_number="18005553333",
+                     date_of_birth=datetime.date(year=1990, month=1, day=1))
+            patients.user_set.add(user)
+            users.append(user)
+        return users
+
+    def _export_patients(self, output=None, **options):
+        if output is None:
+            output = tempfile.mkdtemp()
+            self.addCleanup(shutil.rmtree, output)
+        call_command('export_patients', output, stdout=io.StringIO(), **options)
+        return output
+
+    def _exported_emails(self, output):
+        emails = []
+        for name in sorted(os.listdir(output)):
+            if name.endswith('.ndjson.gz'):
+                with gzip.open(os.path.join(output, name), 'rt') as f:
+                    emails.extend(json.loads(line)['email'] for line in f)
+        return emails
+
+    def test_export_patients_in_chunks(self):
+        users = [self.patient] + self._add_patients(4)
+        output = self._export_patients(chunk_size=2)
+        self.assertEqual(self._exported_emails(output), [u.email for u in users])
+
+        with open(os.path.join(output, export_patients.RANGES_CHECKPOINT)) as f:
+            ranges = json.load(f)
+        self.assertEqual(ranges['ranges'], [[users[0].pk, users[-1].pk]])
+        self.assertEqual(ranges['filters'], {'hospital': None,
+                                             'admitted_after': None,
+                                             'admitted_before': None})
+        name = os.path.join(output, 'patients-%d-%d.ndjson.gz'
+                                    % (users[0].pk, users[-1].pk))
+        self.assertEqual(export_patients.read_checkpoint(name + '.checkpoint'),
+                         (users[-1].pk, os.path.getsize(name)))
+
+        # Finished ranges are skipped when the command is run again.
+        self._export_patients(output, chunk_size=2)
+        self.assertEqual(self._exported_emails(output), [u.email for u in users])
+
+    def test_export_patients_split_across_workers(self):
+        users = [self.patient] + self._add_patients(3)
+        pool = mock.MagicMock()
+        pool.map.side_effect = lambda function, tasks: list(map(function, tasks))
+        with mock.patch.object(export_patients.multiprocessing, 'Pool',
+                               return_value=pool) as Pool:
+            output = self._export_patients(workers=2)
+        Pool.assert_called_once_with(2)
+        first, last = users[0].pk, users[-1].pk
+        middle = first + (last - first) // 2
+        self.assertEqual(export_patients.read_ranges(os.path.join(
+                             output, export_patients.RANGES_CHECKPOINT))[1],
+                         [(first, middle), (middle + 1, last)])
+        self.assertEqual(self._exported_emails(output), [u.email for u in users])
+
+    def test_export_patients_resumes_half_written_file(self):
+        users = [self.patient] + self._add_patients(4)
+        export_chunks = export_patients.export_chunks
+
+        def interrupted(*args, **kwargs):
+            chunks = export_chunks(*args, **kwargs)
+            yield next(chunks)
+            raise KeyboardInterrupt
+
+        output = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output)
+        with mock.patch.object(export_patients, 'export_chunks', interrupted):
+            with self.assertRaises(KeyboardInterrupt):
+                self._export_patients(output, chunk_size=2)
+        name = os.path.join(output, 'patients-%d-%d.ndjson.gz'
+                                    % (users[0].pk, users[-1].pk))
+        # A chunk cut off half-way through writing is truncated on resume.
+        with open(name, 'ab') as f:
+            f.write(gzip.compress(b'{"email": "partial')[:10])
+
+        self._export_patients(output, chunk_size=2)
+        self.assertEqual(self._exported_emails(output), [u.email for u in users])
+
+    def test_export_patients_filtered(self):
+        highland = Hospital.objects.get(name="Highland Hospital")
+        rit = Hospital.objects.get(name="RIT Health Center")
+        current, discharged, split = self._add_patients(3)
+        highland.admit(current)
+        highland.admit(discharged)
+        highland.discharge(discharged)
+        # One stay admitted before the window and one after it: neither
+        # stay falls inside it.
+        rit.admit(split)
+        rit.discharge(split)
+        highland.admit(split)
+        HospitalStay.objects.filter(patient=split, hospital=rit).update(
+            admission=datetime.datetime(2015, 1, 1, tzinfo=pytz.utc))
+        HospitalStay.objects.filter(patient=split, hospital=highland).update(
+            admission=datetime.datetime(2015, 3, 1, tzinfo=pytz.utc))
+        HospitalStay.objects.filter(patient=current).update(
+            admission=datetime.datetime(2015, 2, 1, tzinfo=pytz.utc))
+
+        output = self._export_patients(hospital=highland.pk)
+        self.assertEqual(self._exported_emails(output),
+                         [current.email, split.email])
+
+        output = self._export_patients(admitted_after='2015-01-15',
+                                       admitted_before='2015-02-15')
+        self.assertEqual(self._exported_emails(output), [current.email])
+        with self.assertRaisesRegex(CommandError, 'different filters'):
+            self._export_patients(output, admitted_after='2015-01-15')
+
+    def test_patient_directory(self):
+        patients = Group.objects.get(name="Patient")
+        highland = Hospital.objects.get(name="Highland Hospital")
+        for last_name in ["Adams", "Baker", "Clark"]:
+            email = "%s@example.com" % last_name.lower()
+            patient = User.objects.create_user(
+                email, email=email, first_name="Pat", last_name=last_name,
+                password="p@ssword", phone_number="18005553333",
+                date_of_birth=datetime.date(1990, 1, 1))
+            patients.user_set.add(patient)
+            highland.admit(patient)
+
+        nurse = User.objects.get(pk=self.nurse.pk)
+        self.assertEqual(list(nurse.all_patients()), [self.patient])
+
+        doctor = User.objects.get(pk=self.doctor.pk)
+        page, cursor = doctor.patient_directory(limit=2)
+        self.assertEqual([p.last_name for p in page], ["Adams", "Baker"])
+        page, cursor = doctor.patient_directory(cursor=cursor, limit=2)
+        self.assertEqual([p.last_name for p in page],
+                         ["Clark", "Theroc-Johnson"])
+        self.assertIsNone(cursor)
+
+        page, cursor = doctor.patient_directory(prefix="ba")
+        self.assertEqual([p.last_name for p in page], ["Baker"])
+
+    def test_calendar_feed(self):
+        Appointment.objects.create(doctor=self.doctor, patient=self.patient,
+                                   date=timezone.now(), duration=30)
+        token = ical.feed_token(self.doctor)
+        self.assertTrue(ical.check_feed_token(self.doctor.pk, token))
+        self.assertFalse(ical.check_feed_token(self.patient.pk, token))
+
+        feed = ''.join(ical.stream_calendar(self.doctor, self.doctor.schedule()))
+        self.assertTrue(feed.startswith('BEGIN:VCALENDAR\r\n'))
+        self.assertIn('SUMMARY:Appointment with Duwayne Theroc-Johnson\r\n', feed)
+        self.assertTrue(all(len(line.encode('utf-8')) <= 75
+                            for line in feed.split('\r\n')))
+
+    def test_calendar_feed_revalidation(self):
+        appointment = Appointment.objects.create(
+            doctor=self.doctor, patient=self.patient, date=timezone.now(),
+            duration=30)
+        url = reverse('health:calendar_feed', args=(
+            self.doctor.pk, ical.feed_token(self.doctor)))
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertFalse(response.has_header('Last-Modified'))
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # If-Modified-Since alone cannot tell that nothing was deleted.
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=http_date())
+        self.assertEqual(response.status_code, 200)
+
+        appointment.delete()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        feed = b''.join(response.streaming_content).decode('utf-8')
+        self.assertNotIn('Duwayne', feed)
+
+    def test_audit_log(self):
+        hospital = self.patient.hospital()
+        auditlog.log_action(self.doctor.pk, hospital, ADDITION)
+        entry = LogEntry.objects.get()
+        self.assertEqual(entry.object_repr, repr(hospital))
+        self.assertEqual(entry.action_flag, ADDITION)
+
+        entries = [LogEntry(user_id=self.doctor.pk,
+                            content_type_id=entry.content_type_id,
+                            object_id=str(hospital.pk), action_flag=CHANGE,
+                            change_message='Changed name.')
+                   for _ in range(10)]
+        with self.assertNumQueries(1):
+            auditlog.write(entries)
+        self.assertEqual(LogEntry.objects.filter(action_flag=CHANGE).count(), 10)
+
+    def test_audit_log_repr_taken_when_logged(self):
+        hospital = self.patient.hospital()
+        logged = repr(hospital)
+        entries = []
+        with mock.patch.object(auditlog, 'enqueue', entries.append):
+            auditlog.log_action(self.doctor.pk, hospital, CHANGE)
+        hospital.name = 'Renamed Hospital'
+        auditlog.write(entries)
+        self.assertEqual(LogEntry.objects.get().object_repr, logged)
+
+    def test_audit_log_failed_batch_retried(self):
+        hospital = self.patient.hospital()
+        content_type = ContentType.objects.get_for_model(hospital)
+        entries = [LogEntry(user_id=self.doctor.pk,
+                            content_type_id=content_type.pk,
+                            object_id=str(hospital.pk), action_flag=CHANGE,
+                            object_repr=repr(hospital))
+                   for _ in range(3)]
+        # The batch fails as a whole because of one bad entry.
+        entries[1].user_id = None
+        for entry in entries:
+            auditlog._queue.put_nowait(entry)
+        with self.assertLogs(auditlog.logger, 'WARNING') as logs:
+            auditlog.write_batch(auditlog.take_batch(0))
+        self.assertEqual(LogEntry.objects.count(), 2)
+        self.assertEqual([r.levelname for r in logs.records],
+                         ['WARNING', 'ERROR'])
+
+    def test_activity_events(self):
+        prescription = Prescription.objects.create(
+            patient=self.patient, name="Aspirin", dosage="100mg",
+            directions="Daily", prescribed=timezone.now(), active=True)
+        signals.prescription_added.send(Prescription, user=self.doctor,
+                                        prescription=prescription)
+        signals.prescription_edited.send(Prescription, user=self.doctor,
+                                         prescription=prescription,
+                                         fields=['dosage'])
+        signals.patients_exported.send(User, user=self.patient,
+                                       patients=[self.patient.pk],
+                                       format='json')
+
+        week_ago = timezone.now() - datetime.timedelta(days=7)
+        with self.assertNumQueries(1):
+            events = list(self.doctor.activity_since(week_ago))
+        self.assertEqual([e.action for e in events],
+                         ['prescription.edited', 'prescription.added'])
+        self.assertEqual(events[0].data(), {'fields': ['dosage'],
+                                            'patient': self.patient.pk})
+        self.assertEqual(events[0].object_id, prescription.pk)
+        self.assertEqual(self.doctor.activity_since(
+            week_ago, action='prescription.added').count(), 1)
+
+    def test_synthetic_dataset(self):
+        created = synthetic.Generator(seed=1).generate(
+            hospitals=2, doctors=3, nurses=1, patients=5,
+            appointments_per_patient=2, prescriptions_per_patient=1,
+            messages_per_group=4, chunk_size=2)
+        patients = User.objects.filter(pk__in=created['patients'])
+        self.assertEqual(patients.filter(groups__name='Patient').count(), 5)
+        self.assertEqual(Appointment.objects.filter(
+            patient__in=patients).count(), 10)
+        self.assertEqual(Message.objects.filter(
+            group__members=created['patients'][0]).count(), 4)
+        self.assertEqual(patients[0].unread_message_count(), 1)
+        self.assertEqual(patients[0].count_unread_messages(), 1)
+        self.assertEqual(
+            {user.hospital().pk for user in patients},
+            set(created['hospitals']))
+
+    def test_sql_profile(self):
+        self.assertEqual(
+            profiling.fingerprint("SELECT * FROM auth_group WHERE name = 'Doctor'"),
+            profiling.fingerprint("SELECT * FROM auth_group WHERE name = 'Nurse'"))
+        self.assertEqual(profiling.fingerprint("SELECT 1 WHERE id IN (1, 2, 3)"),
+                         "SELECT ? WHERE id IN (?)")
+        profile = profiling.summarize([
+            {'sql': "SELECT * FROM auth_group WHERE name = 'Doctor'", 'time': '0.002'},
+            {'sql': "SELECT * FROM auth_group WHERE name = 'Patient'", 'time': '0.001'},
+            {'sql': "SELECT * FROM health_user WHERE id = 4", 'time': '0.005'},
+        ])
+        self.assertEqual(profile['queries'], 3)
+        self.assertEqual(profile['db_ms'], 8.0)
+        self.assertEqual(profile['duplicates'], [{
+            'sql': "SELECT * FROM auth_group WHERE name = ?", 'count': 2}])
+        self.assertEqual(profile['slowest'][0], {
+            'sql': "SELECT * FROM health_user WHERE id = ?", 'ms': 5.0})
+
+        cache.clear()
+        profiling.record('health:users', profile)
+        self.assertEqual(profiling.worst_endpoints(), [])
+        with override_settings(SHARED_CACHE=True):
+            profiling.record('health:users', profile)
+            profiling.record('health:users', profile)
+        worst = profiling.worst_endpoints()[0]
+        self.assertEqual((worst['endpoint'], worst['requests'], worst['duplicates'],
+                          worst['avg_db_ms']), ('health:users', 2, 2, 8.0))
+
+    @override_settings(SQL_PROFILE_SAMPLE_RATE=1)
+    def test_server_timing_only_for_staff(self):
+        self.client.login(username=self.doctor.username, password="p@ssword")
+        response = self.client.get(reverse('health:home'))
+        self.assertFalse(response.has_header('Server-Timing'))
+
+        User.objects.filter(pk=self.doctor.pk).update(is_staff=True)
+        response = self.client.get(reverse('health:home'))
+        self.assertIn('db;dur=', response['Server-Timing'])
+
+    @override_settings(SQL_PROFILE_SAMPLE_RATE=1)
+    def test_sql_profile_counts_every_database(self):
+        replica = mock.Mock(alias=routers.REPLICA_DB_ALIAS,
+                            force_debug_cursor=False,
+                            queries_log=[{'sql': 'SELECT 1', 'time': '0.001'}])
+        middleware = profiling.SQLProfileMiddleware()
+        request = RequestFactory().get('/')
+        with mock.patch.object(profiling.connections, 'all',
+                               return_value=[connection, replica]):
+            middleware.process_request(request)
+            self.assertTrue(replica.force_debug_cursor)
+            User.objects.count()
+            replica.queries_log.append({'sql': 'SELECT 2', 'time': '0.002'})
+            with self.assertLogs('health.profiling') as logs:
+                middleware.process_response(request, HttpResponse())
+        self.assertFalse(replica.force_debug_cursor)
+        self.assertEqual(json.loads(logs.records[0].getMessage())['queries'], 2)
+
+    def test_availability_grid(self):
+        today = timezone.localtime(timezone.now()).date()
+        start = timezone.make_aware(datetime.datetime.combine(
+            today, datetime.time(9)), timezone.get_current_timezone())
+        appointment = Appointment.objects.create(
+            doctor=self.doctor, patient=self.patient, date=start, duration=30)
+        slot = 9 * 60 // availability.SLOT_MINUTES
+        doctors = [self.doctor.pk, self.patient.pk]
+        grid = availability.grid(doctors, today)
+        self.assertEqual(grid[self.doctor.pk][today],
+                         sum(1 << i for i in range(slot, slot + 2)))
+        self.assertEqual(grid[self.patient.pk][today], 0)
+
+        # The whole week is stored now, so reading it again is one query.
+        with self.assertNumQueries(1):
+            self.assertEqual(availability.grid(doctors, today), grid)
+
+        appointment.date = start + datetime.timedelta(days=1)
+        appointment.save()
+        grid = availability.grid(doctors, today)
+        self.assertEqual(grid[self.doctor.pk][today], 0)
+        self.assertTrue(grid[self.doctor.pk][today + datetime.timedelta(days=1)])
+
+        appointment.delete()
+        grid = availability.grid(doctors, today)
+        self.assertFalse(any(grid[self.doctor.pk].values()))
+
+    def test_availability_excludes_edited_appointment(self):
+        today = timezone.localtime(timezone.now()).date()
+        start = timezone.make_aware(datetime.datetime.combine(
+            today, datetime.time(9)), timezone.get_current_timezone())
+        edited = Appointment.objects.create(
+            doctor=self.doctor, patient=self.patient, date=start, duration=30)
+        Appointment.objects.create(
+            doctor=self.doctor, patient=self.patient,
+            date=start + datetime.timedelta(minutes=15), duration=30)
+        slot = 9 * 60 // availability.SLOT_MINUTES
+
+        def busy(user, **params):
+            self.client.login(username=user.username, password="p@ssword")
+            response = self.client.get(reverse('health:availability'),
+                                       dict(params, start=today.isoformat(),
+                                            days=1))
+            doctor, = [d for d in json.loads(response.content.decode())['doctors']
+                       if d['id'] == self.doctor.pk]
+            return int(doctor['busy'][0], 16)
+
+        self.assertEqual(busy(self.patient),
+                         sum(1 << i for i in range(slot, slot + 3)))
+        # Slots shared with another appointment stay busy.
+        self.assertEqual(busy(self.patient, exclude=edited.pk),
+                         sum(1 << i for i in range(slot + 1, slot + 3)))
+        # Only the user's own appointments can be left out.
+        self.assertEqual(busy(self.nurse, exclude=edited.pk),
+                         sum(1 << i for i in range(slot, slot + 3)))
+
+        response = self.client.get(reverse('health:edit_appointment',
+                                           args=[edited.pk]))
+        self.assertContains(response, 'exclude: %d' % edited.pk)
+
+    def test_availability_outside_window_is_not_stored(self):
+        later = timezone.localtime(timezone.now()).date() + \
+            datetime.timedelta(days=availability.WINDOW_DAYS + 5)
+        self.assertFalse(availability.grid([self.doctor.pk], later, 1)
+                         [self.doctor.pk][later])
+        self.assertFalse(DoctorAvailability.objects.filter(day=later).exists())
+
+        start = timezone.make_aware(datetime.datetime.combine(
+            later, datetime.time(9)), timezone.get_current_timezone())
+        Appointment.objects.create(doctor=self.doctor, patient=self.patient,
+                                   date=start, duration=30)
+        self.assertTrue(availability.grid([self.doctor.pk], later, 1)
+                        [self.doctor.pk][later])
+
+    def test_availability_follows_wall_clock(self):
+        zone = pytz.timezone('US/Eastern')
+        # Clocks go forward on the first day and back on the second.
+        for day, slot_count in ((datetime.date(2026, 3, 8), 92),
+                                (datetime.date(2026, 11, 1), 96)):
+            with timezone.override(zone):
+                start = zone.localize(datetime.datetime.combine(
+                    day, datetime.time(9)))
+                bits = availability.busy_mask(
+                    [(start, start + timedelta(minutes=30))], day)
+                self.assertEqual(bits, 0b11 << (9 * 60 // availability.SLOT_MINUTES))
+                slots = availability.free_slots(0, day)
+                self.assertEqual(len(slots), slot_count)
+                self.assertIn(start, slots)
+                self.assertNotIn(start, availability.free_slots(bits, day))
+
+
+class ConcurrentBookingTestCase(TransactionTestCase):
+
+    def setUp(self):
+        doctors = Group.objects.create(name="Doctor")
+        patients = Group.objects.create(name="Patient")
+        self.doctor = User.objects.create_user(
+            "doctor@example.com", email="doctor@example.com", password="p@ssword",
+            phone_number="18005553333", date_of_birth=datetime.date(1980, 6, 7))
+        doctors.user_set.add(self.doctor)
+        self.patients = []
+        for i in range(8):
+            email = "patient%d@example.com" % i
+            patient = User.objects.create_user(
+                email, email=email, password="p@ssword",
+                phone_number="18005553333",
+                date_of_birth=datetime.date(1990, 1, 1))
+            patients.user_set.add(patient)
+            self.patients.append(patient)
+
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_simultaneous_bookings_do_not_double_book(self):
+        date = timezone.now().replace(microsecond=0) + timedelta(days=1)
+        barrier = threading.Barrier(len(self.patients))
+        results = []
+
+        def book(patient):
+            # New threads read from the replica, if there is one, and
+            # would not see the users created above.
+            routers.pin_to_primary()
+            try:
+                doctor = User.objects.get(pk=self.doctor.pk)
+                barrier.wait()
+                appointment, _ = book_appointment(doctor, patient, date, 30)
+                results.append(appointment)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=book, args=(p,))
+                   for p in self.patients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len([a for a in results if a]), 1)
+        self.assertEqual(Appointment.objects.filter(doctor=self.doctor).count(), 1)
+
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_simultaneous_mark_read_inserts_each_receipt_once(self):
+        patient = self.patients[0]
+        group = MessageGroup.objects.create(name="Results")
+        group.members.add(self.doctor, patient)
+        for i in range(5):
+            Message.objects.create(sender=self.doctor, group=group,
+                                   body="Message %d" % i, date=timezone.now())
+        barrier = threading.Barrier(4)
+        results, errors = [], []
+
+        def mark_read():
+            routers.pin_to_primary()
+            try:
+                barrier.wait()
+                results.append(group.mark_read(patient))
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=mark_read) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(results), [0, 0, 0, 5])
+        self.assertEqual(patient.read_messages.count(), 5)
+
+
+class SearchIndexTestCase(TransactionTestCase):
+    """
+    Builds the search index for real: on SQLite, rolling back the FTS
+    table's creation with a test's transaction corrupts the in-memory
+    test database.
+    """
+    setUp = UserTestCase.setUp
+
+    def tearDown(self):
+        if connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                for suffix in ('ai', 'ad', 'au'):
+                    cursor.execute('DROP TRIGGER IF EXISTS %s_%s'
+                                   % (search.FTS_TABLE, suffix))
+                cursor.execute('DROP TABLE IF EXISTS %s' % search.FTS_TABLE)
+
+    def test_search(self):
+        search.index_users(User.objects.all())
+        backend = None
+        for _ in range(2):
+            results, cursor = search.search("tumor")
+            self.assertEqual(results, [self.patient], backend)
+            self.assertIsNone(cursor)
+
+            results, _ = search.search("Turkleton",
+                                       scope=User.objects.filter(pk=self.nurse.pk))
+            self.assertEqual(results, [self.nurse], backend)
+
+            first, cursor = search.search("sacredheart", page_size=2)
+            rest, last = search.search("sacredheart", cursor=cursor)
+            self.assertEqual(len(first), 2, backend)
+            self.assertEqual(len(first + rest), 4, backend)
+            self.assertEqual(len(set(first + rest)), 4, backend)
+            self.assertIsNone(last)
+
+            if backend == 'postgresql':
+                # A misspelt name matches through the trigram index.
+                results, _ = search.search("Turkleto")
+                self.assertIn(self.nurse, results)
+            # Run the same searches again through the full-text index.
+            backend = search.build_index()
+            if backend is None:
+                break
+
+
+@skipUnless(routers.replica_configured(),
+            'Set REPLICA_DATABASE_URL to a second database to test replicas.')
+class ReplicaRoutingTestCase(TransactionTestCase):
+    """
+    The replica's test database is never written to, so it behaves like a
+    replica that has not caught up with anything yet.
+    """
+    multi_db = True
+
+    def setUp(self):
+        doctors = Group.objects.create(name="Doctor")
+        self.doctor = User.objects.create_user(
+            "doctor@example.com", email="doctor@example.com", password="p@ssword",
+            phone_number="18005553333", date_of_birth=datetime.date(1980, 6, 7))
+        doctors.user_set.add(self.doctor)
+        routers.reset()
+
+    def test_reads_use_replica_unless_pinned(self):
+        self.assertFalse(User.objects.filter(pk=self.doctor.pk).exists())
+        routers.pin_to_primary()
+        self.assertTrue(User.objects.filter(pk=self.doctor.pk).exists())
+        routers.reset()
+
+    def test_user_reads_own_writes_after_login(self):
+        response = self.client.post(reverse('health:login'), {
+            'email': 'doctor@example.com', 'password': 'p@ssword'})
+        self.assertRedirects(response, reverse('health:home'),
+                             fetch_redirect_response=False)
+        # Logging in wrote to the primary, so the session is pinned to it
+        # and the next page sees the user.
+        self.assertEqual(self.client.get(reverse('health:home')).status_code, 200)
+
+        session = self.client.session
+        session[routers.PIN_SESSION_KEY] = 0
+        session.save()
+        # Unpinned, the user is looked up on the lagging replica.
+        response = self.client.get(reverse('health:home'))
+        self.assertEqual(response.status_code, 302)
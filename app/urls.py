@@ -8,11 +8,15 @@ urlpatterns = patterns('',
                        url(r'login/?$', views.login_view, name='login'),
                        url(r'logout/?$', views.logout_view, name='logout'),
                        url(r'schedule/?$', views.schedule, name='schedule'),
+                       url(r'calendar/(\d+)/([\w-]+)\.ics$', views.calendar_feed,
+                           name='calendar_feed'),
                        url(r'prescriptions/?$', views.prescriptions,
                            name='prescriptions'),
                        url(r'messages/?$', views.messages, name='messages'),
                        url(r'messages/(\d+)/?$',
                            views.conversation, name='conversation'),
+                       url(r'messages/(\d+)/older/?$',
+                           views.older_messages, name='older_messages'),
                        url(r'delete_prescription/(\d+)/?$',
                            views.delete_prescription, name='delete_prescription'),
                        url(r'edit_prescription/(\d+)?/?$',
@@ -25,6 +29,8 @@ urlpatterns = patterns('',
                            views.appointment_form, name='edit_appointment'),
                        url(r'add_appointment/?$',
                            views.add_appointment_form, name='add_appointment'),
+                       url(r'availability.json/?$',
+                           views.availability_grid, name='availability'),
                        url(r'add_group/?$', views.add_group, name='add_group'),
                        url(r'users/(\d+)/?$', views.medical_information,
                            name='medical_information'),
@@ -35,7 +41,12 @@ urlpatterns = patterns('',
                            views.export, name='export'),
                        url(r'users/me/info.json/?$',
                            views.export_me, name='export_me'),
+                       url(r'users/export.ndjson/?$',
+                           views.export_patients, name='export_patients'),
                        url(r'users/?$', views.users, name='users'),
+                       url(r'search/?$', views.patient_search, name='search'),
+                       url(r'logs/sql/?$', views.sql_profile,
+                           name='sql_profile'),
                        url(r'logs/?$', views.logs, name='logs'),
                        url(r'^/?$', views.home, name='home'),
                        url(r'^home/?$', views.home1, name='home1'),
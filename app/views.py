@@ -1,18 +1,39 @@
+from django.conf import settings
 from django.shortcuts import render, redirect, get_object_or_404
 from django.utils import dateparse
 from django.core.exceptions import PermissionDenied
 from django.contrib.admin.models import LogEntry
 from django.contrib.auth import logout, login, authenticate
 from django.contrib.auth.decorators import login_required, user_passes_test
-from django.http import HttpResponse
-from django.db.models import Max
+from django.core.urlresolvers import reverse
+from django.http import HttpResponse, StreamingHttpResponse
+from django.views.decorators.http import condition
+from django.db import transaction
+from django.db.models import Count, Max, Prefetch
 from . import form_utilities
 from .form_utilities import *
+from . import activitylog  # Connects the activity signal receivers.
+from . import availability
 from . import checks
+from . import exports
+from . import ical
+from . import profiling
+from . import search
+from . import signals
+from . import statistics
+from .pagination import keyset_page
 from .models import *
 import datetime
+import hashlib
 import json
-import time
+
+LOG_PAGE_SIZE = 100
+SCHEDULE_PAGE_SIZE = 25
+# The User columns the user form edits. Saving only these leaves the
+# denormalized columns (unread_messages, current_stay), which are kept up
+# to date with targeted updates, as they are in the database.
+USER_FORM_FIELDS = ('email', 'phone_number', 'first_name', 'last_name',
+                    'date_of_birth', 'medical_information')
 
 
 def login_view(request):
@@ -103,6 +124,9 @@ def handle_prescription_form(request, body, prescription=None):
             prescription.patient = patient
         prescription.save()
         change(request, prescription, changed_fields)
+        signals.prescription_edited.send(Prescription, user=request.user,
+                                         prescription=prescription,
+                                         fields=changed_fields)
     else:
         prescription = Prescription.objects.create(name=name, dosage=dosage,
                                                    patient=patient, directions=directions,
@@ -111,6 +135,8 @@ def handle_prescription_form(request, body, prescription=None):
         if not prescription:
             return None, "We could not create that prescription. Please try again."
         addition(request, prescription)
+        signals.prescription_added.send(Prescription, user=request.user,
+                                        prescription=prescription)
     return prescription, None
 
 
@@ -122,10 +148,19 @@ def prescriptions(request, error=None):
     :param request: The Django request.
     :return: A rendered version of prescriptions.html
     """
+    prefix = request.GET.get('q')
+    patients, next_cursor = request.user.patient_directory(
+        prefix=prefix, cursor=request.GET.get('after'),
+        queryset=request.user.directory_queryset(prefix).prefetch_related(
+            Prefetch('prescription_set',
+                     queryset=Prescription.objects.filter(active=True),
+                     to_attr='prefetched_active_prescriptions')))
     context = {
         "navbar": "prescriptions",
         "logged_in_user": request.user,
-        "prescriptions": request.user.prescription_set.filter(active=True).all()
+        "patients": patients,
+        "query": prefix or '',
+        "next_cursor": next_cursor,
     }
     if error:
         context["error_message"] = error
@@ -157,7 +192,9 @@ def delete_prescription(request, prescription_id):
     p = get_object_or_404(Prescription, pk=prescription_id)
     p.active = False
     p.save()
-    deletion(request, p, repr(p))
+    deletion(request, p)
+    signals.prescription_deleted.send(Prescription, user=request.user,
+                                      prescription=p)
     return redirect('health:prescriptions')
 
 
@@ -239,8 +276,7 @@ def handle_add_group_form(request, body):
     for r in recipients:
         group.members.add(r)
     group.save()
-    Message.objects.create(sender=request.user, body=message,
-                           group=group, date=timezone.now())
+    group.post(request.user, message)
     return group, None
 
 
@@ -272,7 +308,11 @@ def medical_information(request, user_id):
     /users/<user_id>/
     :return:
     """
-    requested_user = get_object_or_404(User, pk=user_id)
+    if str(user_id) == str(request.user.pk):
+        # Reuse the logged-in user, whose roles are already loaded.
+        requested_user = request.user
+    else:
+        requested_user = get_object_or_404(User, pk=user_id)
     is_editing_own_medical_information = requested_user == request.user
     if not is_editing_own_medical_information and not\
             request.user.can_edit_user(requested_user):
@@ -378,10 +418,10 @@ def handle_user_form(request, body, user=None):
             )
             addition(request, user.medical_information)
             user.medical_information = medical_information
-        if (hospital and
-            not HospitalStay.objects.filter(patient=user, hospital=hospital,
-                                            discharge__isnull=True).exists()):
+        if hospital and user.hospital() != hospital:
             hospital.admit(user)
+            signals.patient_admitted.send(User, user=request.user,
+                                          patient=user, hospital=hospital)
         if user.is_superuser:
             if not user.groups.filter(pk=group.pk).exists():
                 for user_group in user.groups.all():
@@ -389,7 +429,9 @@ def handle_user_form(request, body, user=None):
                     user_group.save()
                 group.user_set.add(user)
                 group.save()
-        user.save()
+                user.clear_group_cache()
+        user.save(update_fields=USER_FORM_FIELDS)
+        search.index_user(user)
         change(request, user, 'Changed fields.')
         return user, None
     else:
@@ -412,11 +454,14 @@ def handle_user_form(request, body, user=None):
         if user is None:
             return None, "We could not create that user. Please try again."
         hospital.admit(user)
+        search.index_user(user)
         request.user = user
         addition(request, user)
         addition(request, medical_information)
         addition(request, insurance)
         group.user_set.add(user)
+        signals.patient_admitted.send(User, user=user, patient=user,
+                                      hospital=hospital)
         return user, None
 
 
@@ -426,19 +471,14 @@ def messages(request, error=None):
     if not request.user.is_superuser:
         other_groups.remove(request.user.groups.first().name)
     recipients = (User.objects.filter(groups__name__in=other_groups))
-    message_groups = request.user.messagegroup_set\
-                            .annotate(max_date=Max('messages__date'))\
-                            .order_by('-max_date').all()
-    for group in message_groups:
-        for message in group.messages.all():
-            if request.user not in message.read_members.all():
-                group.has_unread = True
-                break
+    message_groups, next_cursor = request.user.inbox(
+        cursor=request.GET.get('before'))
     context = {
         'navbar': 'messages',
         'user': request.user,
         'recipients': recipients,
         'groups': message_groups,
+        'next_cursor': next_cursor,
         'error_message': error
     }
     return render(request, 'messages.html', context)
@@ -446,45 +486,83 @@ def messages(request, error=None):
 
 def users(request):
 
-    hospital = request.user.hospital()
-    doctors = hospital.users_in_group('Doctor')
-    patients = hospital.users_in_group('Patient')
-    nurses = hospital.users_in_group('Nurse')
+    rosters = request.user.hospital().rosters()
     context = {
         'navbar': 'users',
-        'doctors': doctors,
-        'nurses': nurses,
-        'patients': patients
+        'doctors': rosters['Doctor'],
+        'nurses': rosters['Nurse'],
+        'patients': rosters['Patient']
     }
     return render(request, 'users.html', context)
 
 
+@login_required
+def patient_search(request):
+    """
+    Ranked search over the patients visible to the logged-in user, by
+    name, email, phone or medical information.
+    """
+    if request.user.is_patient() and not request.user.is_superuser:
+        raise PermissionDenied
+    query = request.GET.get('q', '')
+    results, next_cursor = search.search(
+        query, scope=request.user.all_patients(),
+        cursor=request.GET.get('after'))
+    context = {
+        'navbar': 'search',
+        'query': query,
+        'results': results,
+        'next_cursor': next_cursor,
+    }
+    return render(request, 'search.html', context)
+
+
 @login_required
 def conversation(request, id):
+    """
+    Shows the newest page of a conversation, oldest message at the top.
+    Older messages are loaded incrementally from older_messages.
+    """
     group = get_object_or_404(MessageGroup, pk=id)
+    if not group.members.filter(pk=request.user.pk).exists():
+        raise PermissionDenied
+    page, next_cursor = group.messages_page()
     context = {
         "user": request.user,
         "group": group,
+        "messages": list(reversed(page)),
+        "next_cursor": next_cursor,
         "message_names": group.combined_names(full=True)
     }
     if request.POST:
         message = request.POST.get('message')
         if message:
-            msg = Message.objects.create(sender=request.user, group=group,
-                                         body=message, date=timezone.now())
-            group.messages.add(msg)
-            group.save()
+            group.post(request.user, message)
             # redirect to avoid the issues with reloading
             # sending the message again.
             return redirect('health:conversation', group.pk)
-    for message in group.messages.all():
-        if request.user not in message.read_members.all():
-            message.read_members.add(request.user)
-            message.save()
+    if page:
+        group.mark_read(request.user, up_to=max(m.pk for m in page))
 
     return render(request, 'conversation.html', context)
 
 
+@login_required
+def older_messages(request, id):
+    """
+    Returns the page of messages preceding the 'before' cursor as JSON,
+    newest first, along with the cursor for the page after it.
+    """
+    group = get_object_or_404(MessageGroup, pk=id)
+    if not group.members.filter(pk=request.user.pk).exists():
+        raise PermissionDenied
+    page, next_cursor = group.messages_page(cursor=request.GET.get('before'))
+    return HttpResponse(json.dumps({
+        'messages': [m.json_object() for m in page],
+        'next_cursor': next_cursor,
+    }), content_type='application/json')
+
+
 def handle_appointment_form(request, body, user, appointment=None):
     """
     Validates the provided fields for an appointment request and creates one
@@ -519,23 +597,55 @@ def handle_appointment_form(request, body, user, appointment=None):
             changed.append('duration')
         if appointment.doctor != doctor:
             changed.append('doctor')
-        appointment.delete()
-    if not doctor.is_free(parsed, duration):
-        return None, "The doctor is not free at that time." +\
-                     " Please specify a different time."
 
-    if not patient.is_free(parsed, duration):
-        return None, "The patient is not free at that time." +\
-                     " Please specify a different time."
-    appointment = Appointment.objects.create(date=parsed, duration=duration,
-                                             doctor=doctor, patient=patient)
+    appointment, message = book_appointment(doctor, patient, parsed, duration,
+                                            appointment=appointment)
+    if not appointment:
+        return None, message
 
     if is_change:
         change(request, appointment, changed)
+        signals.appointment_edited.send(Appointment, user=request.user,
+                                        appointment=appointment,
+                                        fields=changed)
     else:
         addition(request, appointment)
-    if not appointment:
-        return None, "We could not create the appointment. Please try again."
+        signals.appointment_added.send(Appointment, user=request.user,
+                                       appointment=appointment)
+    return appointment, None
+
+
+def book_appointment(doctor, patient, date, duration, appointment=None):
+    """
+    Books (or, if an appointment is given, reschedules) an appointment as
+    one atomic operation.
+    The doctor's and patient's rows are locked for the duration of the
+    transaction, so concurrent bookings for the same people are
+    serialized and cannot both pass the availability check. A failed
+    reschedule leaves the original appointment untouched.
+    :return: A tuple containing either the saved appointment or a
+             failure message.
+    """
+    with transaction.atomic():
+        # Lock in primary key order so two bookings for the same pair
+        # cannot deadlock each other.
+        list(User.objects.select_for_update()
+                         .filter(pk__in=[doctor.pk, patient.pk])
+                         .order_by('pk'))
+        if not doctor.is_free(date, duration, ignore=appointment):
+            return None, "The doctor is not free at that time." +\
+                         " Please specify a different time."
+
+        if not patient.is_free(date, duration, ignore=appointment):
+            return None, "The patient is not free at that time." +\
+                         " Please specify a different time."
+        if appointment is None:
+            appointment = Appointment()
+        appointment.doctor = doctor
+        appointment.patient = patient
+        appointment.date = date
+        appointment.duration = duration
+        appointment.save()
     return appointment, None
 
 
@@ -550,12 +660,12 @@ def appointment_form(request, appointment_id):
             request.user, appointment=appointment
         )
         return schedule(request, error=message)
-    hospital = request.user.hospital()
+    rosters = request.user.hospital().rosters()
     context = {
         "user": request.user,
         'appointment': appointment,
-        "doctors": hospital.users_in_group('Doctor'),
-        "patients": hospital.users_in_group('Patient')
+        "doctors": rosters['Doctor'],
+        "patients": rosters['Patient']
     }
     return render(request, 'edit_appointment.html', context)
 
@@ -568,32 +678,135 @@ def schedule(request, error=None):
     Also shows a table of the existing appointments for the logged-in user.
     """
     now = timezone.now()
-    hospital = request.user.hospital()
+    rosters = request.user.hospital().rosters()
+    appointments = request.user.schedule().select_related('doctor', 'patient')
+    schedule_past, next_cursor = keyset_page(
+        appointments.filter(date__lt=now), 'date',
+        cursor=request.GET.get('before'), limit=SCHEDULE_PAGE_SIZE)
     context = {
         "navbar": "schedule",
         "user": request.user,
-        "doctors": hospital.users_in_group('Doctor'),
-        "patients": hospital.users_in_group('Patient'),
-        "schedule_future": request.user.schedule()
-                                       .filter(date__gte=now)
+        "doctors": rosters['Doctor'],
+        "patients": rosters['Patient'],
+        "schedule_future": appointments.filter(date__gte=now)
                                        .order_by('date'),
-        "schedule_past": request.user.schedule()
-                                     .filter(date__lt=now)
-                                     .order_by('-date')
+        "schedule_past": schedule_past,
+        "next_cursor": next_cursor,
+        "calendar_url": request.build_absolute_uri(reverse(
+            'health:calendar_feed',
+            args=(request.user.pk, ical.feed_token(request.user))))
     }
     if error:
         context['error_message'] = error
     return render(request, 'schedule.html', context)
 
 
+def calendar_state(request, user_id, token):
+    """
+    Looks up the owner of a calendar feed and summarizes their schedule
+    with one aggregate query, memoized on the request so the ETag check
+    and the view share it.
+    :return: A tuple of the user and a dictionary with the number of
+             appointments and the latest modification time.
+    """
+    if not hasattr(request, 'calendar_state'):
+        if not ical.check_feed_token(user_id, token):
+            raise PermissionDenied
+        user = get_object_or_404(User, pk=user_id)
+        state = user.schedule().aggregate(count=Count('pk'),
+                                          modified=Max('modified'))
+        request.calendar_state = user, state
+    return request.calendar_state
+
+
+def calendar_etag(request, user_id, token):
+    user, state = calendar_state(request, user_id, token)
+    # The count changes when an appointment is deleted, which the latest
+    # modification time alone would miss.
+    modified = state['modified'].isoformat() if state['modified'] else ''
+    key = '%s:%s:%s' % (user.pk, state['count'], modified)
+    return hashlib.md5(key.encode('utf-8')).hexdigest()
+
+
+# There is no last_modified_func: the latest modification time misses
+# deleted appointments, so a client revalidating with If-Modified-Since
+# alone would keep them. Such clients get the full feed instead.
+@condition(etag_func=calendar_etag)
+def calendar_feed(request, user_id, token):
+    """
+    Streams the user's schedule as an iCalendar feed for calendar clients.
+    Polls that send a matching If-None-Match get a 304 without the
+    schedule being loaded.
+    """
+    user, _ = calendar_state(request, user_id, token)
+    appointments = user.schedule().select_related('doctor', 'patient')\
+                                  .order_by('date')
+    return StreamingHttpResponse(ical.stream_calendar(user, appointments),
+                                 content_type='text/calendar; charset=utf-8')
+
+
 @login_required
 def add_appointment_form(request):
     return appointment_form(request, None)
 
 
+@login_required
+def availability_grid(request):
+    """
+    Returns the precomputed availability of every doctor at the user's
+    hospital as JSON, for the booking form to show which times are taken.
+    Accepts an optional 'start' day (YYYY-MM-DD, default today), a
+    number of 'days' (default 7) and an appointment to 'exclude', so a
+    form editing one of the user's appointments does not see its own
+    slots as taken.
+    Each day is a hexadecimal bitmap in which bit i is set when the doctor
+    is busy during the i-th slot of 'slot_minutes' minutes after midnight
+    by the local wall clock.
+    """
+    hospital = request.user.hospital()
+    if not hospital:
+        raise PermissionDenied
+    start = dateparse.parse_date(request.GET.get('start', '') or '')
+    if not start:
+        start = timezone.localtime(timezone.now()).date()
+    try:
+        days = int(request.GET.get('days', 7))
+    except ValueError:
+        days = 7
+    days = min(max(days, 1), availability.WINDOW_DAYS)
+    doctors = hospital.rosters()['Doctor']
+    grid = availability.grid([d.pk for d in doctors], start, days)
+    exclude = request.GET.get('exclude', '')
+    if exclude.isdigit():
+        appointment = request.user.schedule().filter(pk=exclude).first()
+        if appointment and appointment.doctor_id in grid:
+            # The stored bitmaps include the appointment, so its doctor's
+            # days are computed again without it.
+            masks = availability.compute([appointment.doctor_id],
+                                         sorted(grid[appointment.doctor_id]),
+                                         exclude=appointment.pk)
+            grid[appointment.doctor_id] = {day: bits for (_, day), bits
+                                           in masks.items()}
+    width = availability.SLOTS_PER_DAY // 4
+    return HttpResponse(json.dumps({
+        'slot_minutes': availability.SLOT_MINUTES,
+        'start': start.isoformat(),
+        'days': days,
+        'doctors': [{
+            'id': doctor.pk,
+            'name': doctor.get_full_name(),
+            'busy': ['%0*x' % (width, bits)
+                     for _, bits in sorted(grid[doctor.pk].items())],
+        } for doctor in doctors],
+    }), content_type='application/json')
+
+
 @login_required
 def delete_appointment(request, appointment_id):
     a = get_object_or_404(Appointment, pk=appointment_id)
+    # Sent first, while the appointment still has its primary key.
+    signals.appointment_deleted.send(Appointment, user=request.user,
+                                     appointment=a)
     a.delete()
     return redirect('health:schedule')
 
@@ -601,46 +814,40 @@ def delete_appointment(request, appointment_id):
 @login_required
 @user_passes_test(checks.admin_check)
 def logs(request):
-    group_count = MessageGroup.objects.count()
-    average_count = 0
-    message_count = Message.objects.count()
-    hospital = request.user.hospital()
-    if group_count > 0 and message_count > 0:
-        average_count = float(message_count) / float(group_count)
-    stays = HospitalStay.objects.filter(discharge__isnull=False)
-    average_stay = 0.0
-    if stays:
-        for stay in stays:
-            average_stay += float((stay.discharge - stay.admission).total_seconds())
-        average_stay /= len(stays)
-    average_stay_formatted = time.strftime('%H:%M:%S', time.gmtime(average_stay))
+    """
+    Shows the system statistics for the admin's hospital and the audit
+    log, newest first, one page at a time.
+    """
+    log_entries, next_cursor = keyset_page(
+        LogEntry.objects.select_related('user'), 'action_time',
+        cursor=request.GET.get('before'), limit=LOG_PAGE_SIZE)
     context = {
         "navbar": "logs",
         "user": request.user,
-        "logs": LogEntry.objects.all().order_by('-action_time'),
-        "stats": {
-            "user_count": HospitalStay.objects.filter(hospital=hospital, discharge__isnull=True).count(),
-            "stay_count": HospitalStay.objects.filter(hospital=hospital).count(),
-            "discharge_count": HospitalStay.objects.filter(hospital=hospital, discharge__isnull=False).count(),
-            "average_stay": average_stay_formatted,
-            "patient_count": HospitalStay.objects.filter(hospital=hospital, patient__groups__name='Patient').distinct().count(),
-            "doctor_count": HospitalStay.objects.filter(hospital=hospital, patient__groups__name='Doctor').distinct().count(),
-            "nurse_count": HospitalStay.objects.filter(hospital=hospital, patient__groups__name='Nurse').distinct().count(),
-            "admin_count": User.objects.filter(is_superuser=True).count(),
-            "prescription_count": Prescription.objects.count(),
-            "active_prescription_count": Prescription.objects.filter(active=True).count(),
-            "expired_prescription_count": Prescription.objects.filter(active=False).count(),
-            "appointment_count": Appointment.objects.count(),
-            "upcoming_appointment_count": Appointment.objects.filter(date__gte=timezone.now()).count(),
-            "past_appointment_count": Appointment.objects.filter(date__lt=timezone.now()).count(),
-            "conversation_count": group_count,
-            "average_message_count": average_count,
-            "message_count": message_count
-        }
+        "logs": log_entries,
+        "next_cursor": next_cursor,
+        "stats": statistics.hospital_statistics(request.user.hospital())
     }
     return render(request, 'logs.html', context)
 
 
+@login_required
+@user_passes_test(checks.admin_check)
+def sql_profile(request):
+    """
+    Shows the endpoints that spend the most time in the database per
+    request, from the requests sampled by the SQL profiling middleware.
+    """
+    context = {
+        "navbar": "logs",
+        "user": request.user,
+        "endpoints": profiling.worst_endpoints(),
+        "sample_rate": getattr(settings, 'SQL_PROFILE_SAMPLE_RATE', 0),
+        "shared_cache": getattr(settings, 'SHARED_CACHE', False),
+    }
+    return render(request, 'sql_profile.html', context)
+
+
 def home1(request):
     user = User.objects.all()
     context = {
@@ -686,10 +893,28 @@ def export_me(request):
 
 @login_required
 def export(request, id):
-    user = get_object_or_404(User, pk=id)
-    if user != request.user and not request.user.is_superuser:
+    # Check before loading, so nobody can make the server load another
+    # user's records.
+    if str(id) != str(request.user.pk) and not request.user.is_superuser:
         raise PermissionDenied
-    json_object = json.dumps(user.json_object(), sort_keys=True,
-                             indent=4, separators=(',', ': '))
-    return HttpResponse(json_object,
-                        content_type='application/force-download')
+    user = get_object_or_404(exports.export_queryset(User.objects), pk=id)
+    signals.patients_exported.send(User, user=request.user,
+                                   patients=[user.pk], format='json')
+    return StreamingHttpResponse(exports.stream_json(user),
+                                 content_type='application/force-download')
+
+
+@login_required
+@user_passes_test(checks.admin_check)
+def export_patients(request):
+    """
+    Streams the records of every patient visible to the admin as
+    newline-delimited JSON, one patient per line.
+    """
+    signals.patients_exported.send(User, user=request.user, patients=None,
+                                   format='ndjson')
+    response = StreamingHttpResponse(
+        exports.stream_ndjson(request.user.all_patients()),
+        content_type='application/x-ndjson')
+    response['Content-Disposition'] = 'attachment; filename="patients.ndjson"'
+    return response
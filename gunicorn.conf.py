@@ -0,0 +1,26 @@
+# Gunicorn settings for the web process in the Procfile.
+#
+# Worker model: WEB_CONCURRENCY synchronous worker processes, each
+# running GUNICORN_THREADS threads. Every thread handles one request at a
+# time and, with persistent connections (CONN_MAX_AGE in
+# project/settings.py), keeps one database connection open, so a dyno
+# holds up to
+#
+#     WEB_CONCURRENCY * GUNICORN_THREADS
+#
+# connections, plus one per worker while the audit log writer is busy.
+# Multiply by the number of dynos and keep the total under the database's
+# connection limit; past that, run PgBouncer and set DB_POOLER=pgbouncer.
+import os
+
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('GUNICORN_THREADS', 1))
+worker_class = 'gthread' if threads > 1 else 'sync'
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+# Restart workers now and then so memory growth cannot accumulate;
+# the jitter keeps them from all restarting at once.
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = max_requests // 10
+# Exit cleanly on SIGTERM so atexit handlers, such as the audit log
+# flush, run before the worker goes away.
+graceful_timeout = 20
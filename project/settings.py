@@ -44,7 +44,10 @@ INSTALLED_APPS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'app.dbhealth.ConnectionHealthCheckMiddleware',
+    'app.profiling.SQLProfileMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'app.routers.ReplicaPinningMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
@@ -67,6 +70,26 @@ DATABASES = {
     }
 }
 
+# Fraction of requests whose SQL is profiled; see app/profiling.py.
+SQL_PROFILE_SAMPLE_RATE = 1.0 if DEBUG else 0.01
+
+# Cache shared by every gunicorn worker, e.g.
+# MEMCACHED_LOCATION=127.0.0.1:11211 (needs python-memcached). Without
+# one each worker has its own local cache, so data that must agree across
+# workers, like hospital rosters and the SQL profile totals, is not cached.
+SHARED_CACHE = bool(os.environ.get('MEMCACHED_LOCATION'))
+if SHARED_CACHE:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': os.environ['MEMCACHED_LOCATION'].split(','),
+        }
+    }
+
+# Write admin log entries from a background thread in batches instead of
+# inside each request. See app/auditlog.py.
+AUDIT_LOG_ASYNC = True
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.6/topics/i18n/
 
@@ -95,3 +118,35 @@ STATICFILES_DIRS = [
     os.path.join(BASE_DIR, 'static'),
 ]
 django_heroku.settings(locals())
+
+# Production database profile.
+# django_heroku has pointed DATABASES at DATABASE_URL, if it is set. Each
+# gunicorn worker thread keeps its own connection open for DB_CONN_MAX_AGE
+# seconds instead of connecting on every request (see gunicorn.conf.py
+# for how many connections that adds up to), and connections idle for
+# more than DB_HEALTH_CHECK_INTERVAL seconds are checked before use so a
+# database restart does not fail the next request.
+# With DB_POOLER=pgbouncer, DATABASE_URL points at a PgBouncer in
+# transaction pooling mode. PgBouncer then owns the server connections,
+# so Django connects to it per request and skips the health checks. Set
+# the database's timezone to UTC so Django never needs a session-level
+# SET TIME ZONE, which transaction pooling cannot keep.
+DB_POOLER = os.environ.get('DB_POOLER', '')
+if DATABASES['default']['ENGINE'] != 'django.db.backends.sqlite3':
+    DATABASES['default']['CONN_MAX_AGE'] = int(os.environ.get(
+        'DB_CONN_MAX_AGE', 0 if DB_POOLER == 'pgbouncer' else 600))
+DB_HEALTH_CHECK_INTERVAL = int(os.environ.get(
+    'DB_HEALTH_CHECK_INTERVAL', 0 if DB_POOLER == 'pgbouncer' else 30))
+
+# Optional read replica. When REPLICA_DATABASE_URL is set, reads go to it
+# except for requests that may write and, for REPLICA_PIN_SECONDS after
+# any write, for the session that wrote; see app/routers.py. To run the
+# replica tests locally, point it at a second database, e.g.
+# REPLICA_DATABASE_URL=sqlite:///replica.sqlite3 python manage.py test
+DATABASE_ROUTERS = ['app.routers.ReplicaRouter']
+REPLICA_PIN_SECONDS = int(os.environ.get('REPLICA_PIN_SECONDS', 10))
+if os.environ.get('REPLICA_DATABASE_URL'):
+    import dj_database_url
+    DATABASES['replica'] = dj_database_url.parse(
+        os.environ['REPLICA_DATABASE_URL'],
+        conn_max_age=DATABASES['default'].get('CONN_MAX_AGE', 0))